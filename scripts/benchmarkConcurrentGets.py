@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# Measure the latency of concurrent tiddler GETs against a running
+# tiddlyServer wiki, first on their own and then while large tiddlers are
+# being saved (PUT) to the same wiki.
+#
+# If tiddler storage I/O blocks the server's event loop, the p99 latency of
+# the GETs rises sharply once the writes start.
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+benchmarkPrefix = "$:/temp/benchmark/"
+
+writersReady = threading.Event()
+
+def tiddlerUrl(wikiUrl, title, bag=False) :
+  quotedTitle = urllib.parse.quote(title, safe='')
+  if bag :
+    return f"{wikiUrl}/bags/bag/tiddlers/{quotedTitle}"
+  return f"{wikiUrl}/recipes/all/tiddlers/{quotedTitle}"
+
+def tiddlerBody(title, text) :
+  return json.dumps({'title': title, 'text': text}).encode('utf-8')
+
+def putTiddler(wikiUrl, title, body) :
+  request = urllib.request.Request(
+    tiddlerUrl(wikiUrl, title),
+    data=body,
+    headers={'Content-Type': 'application/json'},
+    method='PUT'
+  )
+  urllib.request.urlopen(request).read()
+
+def deleteTiddler(wikiUrl, title) :
+  request = urllib.request.Request(
+    tiddlerUrl(wikiUrl, title, bag=True), method='DELETE'
+  )
+  try :
+    urllib.request.urlopen(request).read()
+  except urllib.error.HTTPError :
+    pass
+
+def timedGet(url) :
+  timeStart = time.perf_counter()
+  urllib.request.urlopen(url).read()
+  return time.perf_counter() - timeStart
+
+def runGets(wikiUrl, numReaders, numRequests) :
+  url = tiddlerUrl(wikiUrl, benchmarkPrefix + "probe")
+  with ThreadPoolExecutor(max_workers=numReaders) as executor :
+    return list(executor.map(timedGet, [url] * numRequests))
+
+def writeTitle(writerNum, writeNum) :
+  return f"{benchmarkPrefix}write-{writerNum}-{writeNum % 10}"
+
+def keepWriting(wikiUrl, writerNum, text, stopWriting, numWrites) :
+  # encode the (large) bodies before we start, so that this (benchmark)
+  # process spends its time waiting on the server rather than holding the
+  # GIL needed by the readers
+  bodies = [
+    tiddlerBody(writeTitle(writerNum, writeNum), text)
+    for writeNum in range(10)
+  ]
+  writersReady.wait()
+  writeNum = 0
+  while not stopWriting.is_set() :
+    putTiddler(
+      wikiUrl, writeTitle(writerNum, writeNum), bodies[writeNum % 10]
+    )
+    writeNum += 1
+  numWrites[writerNum] = writeNum
+
+def report(name, latencies) :
+  latencies = sorted(latencies)
+  p50 = statistics.median(latencies)
+  p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+  print(
+    f"{name:>16}: {len(latencies)} GETs"
+    f"  p50 {p50 * 1000:8.2f} ms"
+    f"  p99 {p99 * 1000:8.2f} ms"
+    f"  max {latencies[-1] * 1000:8.2f} ms"
+  )
+
+def main() :
+  argParser = argparse.ArgumentParser(
+    description="""
+    Benchmark the latency of concurrent tiddler GETs, with and without
+    concurrent (large) tiddler PUTs, against a running tiddlyServer.
+    """
+  )
+  argParser.add_argument(
+    'wikiUrl',
+    help="The url of the wiki (for example http://127.0.0.1:8000/aWiki)"
+  )
+  argParser.add_argument(
+    '--readers', type=int, default=16,
+    help="The number of concurrent GETs (default: 16)"
+  )
+  argParser.add_argument(
+    '--requests', type=int, default=2000,
+    help="The number of GETs in each phase (default: 2000)"
+  )
+  argParser.add_argument(
+    '--writers', type=int, default=4,
+    help="The number of concurrent PUTs (default: 4)"
+  )
+  argParser.add_argument(
+    '--writeSize', type=int, default=1024 * 1024,
+    help="The size, in bytes, of each tiddler PUT (default: 1MiB)"
+  )
+  cliArgs = argParser.parse_args()
+  wikiUrl = cliArgs.wikiUrl.rstrip('/')
+
+  probeTitle = benchmarkPrefix + "probe"
+  putTiddler(wikiUrl, probeTitle, tiddlerBody(probeTitle, "probe"))
+  try :
+    report("GETs only", runGets(wikiUrl, cliArgs.readers, cliArgs.requests))
+
+    stopWriting = threading.Event()
+    numWrites = [0] * cliArgs.writers
+    text = "x" * cliArgs.writeSize
+    writers = [
+      threading.Thread(
+        target=keepWriting,
+        args=(wikiUrl, writerNum, text, stopWriting, numWrites)
+      ) for writerNum in range(cliArgs.writers)
+    ]
+    for aWriter in writers : aWriter.start()
+    time.sleep(1)
+    writersReady.set()
+    timeStart = time.perf_counter()
+    latencies = runGets(wikiUrl, cliArgs.readers, cliArgs.requests)
+    timeTaken = time.perf_counter() - timeStart
+    stopWriting.set()
+    for aWriter in writers : aWriter.join()
+    report("GETs with PUTs", latencies)
+    print(
+      f"{'':>16}  {sum(numWrites)} PUTs of {cliArgs.writeSize} bytes"
+      f" in {timeTaken:.2f} s"
+    )
+  finally :
+    deleteTiddler(wikiUrl, probeTitle)
+    for writerNum in range(cliArgs.writers) :
+      for writeNum in range(10) :
+        deleteTiddler(wikiUrl, writeTitle(writerNum, writeNum))
+
+if __name__ == "__main__" :
+  main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# Compare the time taken to read every tiddler in a directory using the
+# original reader (pathlib globs, then one file at a time) and the
+# single-pass reader (one os.scandir walk, then one file at a time, as with
+# the default `readWorkers: 1`, or several files at a time).
+#
+# By default, temporary directories of 10k, 50k and 100k tiddlers (a mix of
+# .tid and .json+.text files) are created. Alternatively, an existing
+# tiddler directory (for example one on a network filesystem) may be given.
+#
+# NOTE: the operating system's file cache is NOT dropped between runs, to
+# measure cold cache reads, run as root with --dropCaches.
+
+import argparse
+from pathlib import Path
+import tempfile
+import time
+
+from tiddlyServer.tiddlerSerDes import readAllTiddlerFilesBlocking, \
+  readAllTiddlerFilesParallelBlocking, writeTiddler
+
+def createTiddlersBlocking(directory, numTiddlers) :
+  for tiddlerNum in range(numTiddlers) :
+    tiddler = {
+      'title': f"Tiddler {tiddlerNum}",
+      'tags': f"[[tag {tiddlerNum % 10}]]",
+      'text': f"The text of tiddler {tiddlerNum}\n" * 20
+    }
+    if tiddlerNum % 5 == 0 :
+      # a field value with a newline is stored as .json+.text files
+      tiddler['caption'] = "two\nlines"
+    writeTiddler(directory / f"dir{tiddlerNum % 100}", tiddler)
+
+def dropCaches() :
+  with open("/proc/sys/vm/drop_caches", "w") as dropFile :
+    dropFile.write("3\n")
+
+def timeReader(name, readTiddlers, directory, cold) :
+  if cold : dropCaches()
+  timeStart = time.perf_counter()
+  tiddlers = readTiddlers(directory)
+  timeTaken = time.perf_counter() - timeStart
+  print(f"  {name:>10}: {len(tiddlers):7d} tiddlers in {timeTaken:7.3f} s")
+  return tiddlers
+
+def compareReaders(directory, workers, cold) :
+  original = timeReader(
+    "original",
+    lambda aDir : list(readAllTiddlerFilesBlocking(aDir)),
+    directory, cold
+  )
+  for name, numWorkers in [ ("scandir", 1), ("parallel", workers) ] :
+    scanned = timeReader(
+      name,
+      lambda aDir : readAllTiddlerFilesParallelBlocking(
+        aDir, maxWorkers=numWorkers
+      ),
+      directory, cold
+    )
+    if sorted(original, key=str) != sorted(scanned, key=str) :
+      print(f"  ERROR: the {name} reader did not return the same tiddlers")
+
+def main() :
+  argParser = argparse.ArgumentParser(
+    description="""
+    Compare the original and the single-pass (serial and parallel) tiddler
+    readers.
+    """
+  )
+  argParser.add_argument(
+    '--dir',
+    help="An existing tiddler directory to read (rather than creating some)"
+  )
+  argParser.add_argument(
+    '--sizes', default="10000,50000,100000",
+    help="The numbers of tiddlers to create (default: 10000,50000,100000)"
+  )
+  argParser.add_argument(
+    '--workers', type=int, default=8,
+    help="The number of files the parallel reader reads at once (default: 8)"
+  )
+  argParser.add_argument(
+    '--dropCaches', action='store_true', default=False,
+    help="Drop the file cache before each read (requires root)"
+  )
+  cliArgs = argParser.parse_args()
+
+  if cliArgs.dir :
+    print(f"{cliArgs.dir}:")
+    compareReaders(Path(cliArgs.dir), cliArgs.workers, cliArgs.dropCaches)
+    return
+
+  for numTiddlers in [ int(aSize) for aSize in cliArgs.sizes.split(',') ] :
+    with tempfile.TemporaryDirectory() as tmpDir :
+      print(f"{numTiddlers} tiddlers:")
+      createTiddlersBlocking(Path(tmpDir), numTiddlers)
+      compareReaders(Path(tmpDir), cliArgs.workers, cliArgs.dropCaches)
+
+if __name__ == "__main__" :
+  main()
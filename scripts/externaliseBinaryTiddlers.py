@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+# Convert the (base64 encoded) binary tiddlers already stored in a wiki's
+# tiddler directory (in .tid or .json plus .text files) into raw .bin files
+# (plus .meta files), as a wiki with `binaryTiddlers: external` stores any
+# newly saved binary tiddlers.
+#
+# Stop the server (or use a wiki with `watchTiddlers: true`) before
+# converting a wiki's tiddlers.
+
+import argparse
+import base64
+import binascii
+from pathlib import Path
+
+from tiddlyServer.tiddlerSerDes import readAllTiddlerFilesBlocking, \
+  isBinaryTiddler, writeTiddler
+
+def main() :
+  argParser = argparse.ArgumentParser(
+    description="""
+    Store the binary tiddlers of a tiddler directory as raw .bin files.
+    """
+  )
+  argParser.add_argument(
+    'tiddlerDir', help="The tiddler directory of the wiki to convert"
+  )
+  argParser.add_argument(
+    '--dryRun', action='store_true', default=False,
+    help="List the tiddlers which would be converted"
+  )
+  cliArgs = argParser.parse_args()
+  tiddlerDir = Path(cliArgs.tiddlerDir).resolve()
+
+  # (read every tiddler before changing any files)
+  binaryTiddlers = [
+    (aFilename, aTiddler)
+    for aFilename, aTiddler in readAllTiddlerFilesBlocking(tiddlerDir)
+    if aFilename.suffix != ".meta" and isBinaryTiddler(aTiddler) and \
+      aTiddler.get('text')
+  ]
+  numConverted = 0
+  numBytes = 0
+  skippedTitles = []
+  for aFilename, aTiddler in binaryTiddlers :
+    try :
+      base64.b64decode(aTiddler['text'], validate=True)
+    except (binascii.Error, ValueError) :
+      # (writeTiddler would just rewrite it as a .tid or .json tiddler)
+      skippedTitles.append(aTiddler['title'])
+      continue
+    print(f"{aTiddler['title']} ({len(aTiddler['text'])} bytes)")
+    numConverted += 1
+    numBytes += len(aTiddler['text'])
+    if cliArgs.dryRun : continue
+    written = writeTiddler(tiddlerDir, aTiddler, externalBinaries=True)
+    if aFilename not in written :
+      # the tiddler was not stored under the name we would have given it
+      for oldFile in [ aFilename, aFilename.with_suffix(".text") ] :
+        oldFile.unlink(missing_ok=True)
+  print(f"{numConverted} binary tiddlers ({numBytes} bytes)")
+  if skippedTitles :
+    print(f"skipped {len(skippedTitles)} tiddlers whose text is not base64:")
+    for aTitle in skippedTitles :
+      print(f"  {aTitle}")
+
+if __name__ == "__main__" :
+  main()
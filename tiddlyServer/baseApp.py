@@ -26,7 +26,7 @@ def createBaseApp(
   def corsOptions(request : Request) -> Response :
     return Response(
       "", headers={
-        'Allow' : 'OPTIONS,GET,HEAD,PUT,DELETE'
+        'Allow' : 'OPTIONS,GET,HEAD,PUT,POST,DELETE'
       }
     )
 
@@ -90,5 +90,11 @@ def createBaseApp(
 
   app = Starlette(routes=routes, lifespan=appLifespan)
   app.state.wikiApps = wikiApps
+  app.state.maxConcurrentPacks = int(config['maxConcurrentPacks'])
+  app.state.packProcesses = int(config['packProcesses'])
+  app.state.ioWorkers = int(config['ioWorkers'])
+  app.state.packedHtmlBudget = int(
+    float(config['packedHtmlBudget']) * 1024 * 1024
+  )
   return app
 
@@ -8,6 +8,11 @@ import yaml
 
 from tiddlyServer.types import WikiDef, WikiDefs
 
+packBackends = ('thread', 'process')
+durabilities = ('none', 'fsync', 'group')
+preloads = ('eager', 'lazy')
+binaryTiddlerModes = ('embedded', 'external')
+
 def basePath(baseDir : str, aPath : str) -> str :
   if not os.path.isabs(aPath) :
     aPath = os.path.join(baseDir, aPath)
@@ -48,6 +53,73 @@ def checkAWiki(
     aWiki['emptyHtml'] = basePath(aWiki['dir'], 'empty.html')
   if not os.path.isfile(aWiki['emptyHtml']) :
     shutil.copyfile(emptyHtml, aWiki['emptyHtml'])
+  if 'indexTimeout' not in aWiki :
+    aWiki['indexTimeout'] = config['indexTimeout']
+  if 'serveStale' not in aWiki :
+    aWiki['serveStale'] = config['serveStale']
+  if 'maxStaleness' not in aWiki :
+    aWiki['maxStaleness'] = config['maxStaleness']
+  if 'streamIndex' not in aWiki :
+    aWiki['streamIndex'] = config['streamIndex']
+  if 'gzipIndex' not in aWiki :
+    aWiki['gzipIndex'] = config['gzipIndex']
+  if 'splitStore' not in aWiki :
+    aWiki['splitStore'] = config['splitStore']
+  if 'changeLogSize' not in aWiki :
+    aWiki['changeLogSize'] = config['changeLogSize']
+  if 'watchTiddlers' not in aWiki :
+    aWiki['watchTiddlers'] = config['watchTiddlers']
+  if 'watchDebounce' not in aWiki :
+    aWiki['watchDebounce'] = config['watchDebounce']
+  if 'watchPollInterval' not in aWiki :
+    aWiki['watchPollInterval'] = config['watchPollInterval']
+  if 'rebuildQuietPeriod' not in aWiki :
+    aWiki['rebuildQuietPeriod'] = config['rebuildQuietPeriod']
+  if 'rebuildMaxDelay' not in aWiki :
+    aWiki['rebuildMaxDelay'] = config['rebuildMaxDelay']
+  if 'packBackend' not in aWiki :
+    aWiki['packBackend'] = config['packBackend']
+  if aWiki['packBackend'] not in packBackends :
+    wikiDie(f"The packBackend key MUST be one of {packBackends}", aWiki)
+  if 'binaryTiddlers' not in aWiki :
+    aWiki['binaryTiddlers'] = config['binaryTiddlers']
+  if aWiki['binaryTiddlers'] not in binaryTiddlerModes :
+    wikiDie(
+      f"The binaryTiddlers key MUST be one of {binaryTiddlerModes}", aWiki
+    )
+  if 'lazyTextSize' not in aWiki :
+    aWiki['lazyTextSize'] = config['lazyTextSize']
+  if not isinstance(aWiki['lazyTextSize'], int) or \
+    isinstance(aWiki['lazyTextSize'], bool) :
+    wikiDie("The lazyTextSize key MUST be a whole number", aWiki)
+  if 'lazyTextTitles' not in aWiki :
+    aWiki['lazyTextTitles'] = config['lazyTextTitles']
+  if not isinstance(aWiki['lazyTextTitles'], list) or not all(
+    isinstance(aPattern, str) for aPattern in aWiki['lazyTextTitles']
+  ) :
+    wikiDie("The lazyTextTitles key MUST be a list of title patterns", aWiki)
+  if 'preload' not in aWiki :
+    aWiki['preload'] = config['preload']
+  if aWiki['preload'] not in preloads :
+    wikiDie(f"The preload key MUST be one of {preloads}", aWiki)
+  if 'snapshot' not in aWiki :
+    aWiki['snapshot'] = None
+    if config['snapshotDir'] :
+      aWiki['snapshot'] = os.path.join(config['snapshotDir'], aKey)
+  if aWiki['snapshot'] :
+    aWiki['snapshot'] = basePath(baseDir, aWiki['snapshot'])
+    snapshotDir = os.path.dirname(os.path.abspath(aWiki['snapshot']))
+    wikiDir = os.path.abspath(aWiki['dir'])
+    if os.path.commonpath([snapshotDir, wikiDir]) == wikiDir :
+      wikiDie("The snapshot MUST NOT be inside the wiki's dir", aWiki)
+  if 'snapshotInterval' not in aWiki :
+    aWiki['snapshotInterval'] = config['snapshotInterval']
+  if 'readWorkers' not in aWiki :
+    aWiki['readWorkers'] = config['readWorkers']
+  if 'durability' not in aWiki :
+    aWiki['durability'] = config['durability']
+  if aWiki['durability'] not in durabilities :
+    wikiDie(f"The durability key MUST be one of {durabilities}", aWiki)
 
 def configDie(mesg : str, config : dict[str, Any]) -> NoReturn :
   print(f"{mesg} in the 'wikiConfig.yaml' configuration file")
@@ -123,6 +195,17 @@ def checkWikis(config : dict[str, Any]) -> None :
     if aWikiKey not in config['wikis'] :
       configDie(f"The '{aWikiKey}' wiki key is not found in wikis", config)
 
+  # by default, wikis are preloaded in the wikiOrder (and any wikis not
+  # listed there, last)
+  for aKey, aWiki in configWikis.items() :
+    if 'priority' not in aWiki :
+      aWiki['priority'] = len(config['wikiOrder'])
+      if aKey in config['wikiOrder'] :
+        aWiki['priority'] = config['wikiOrder'].index(aKey)
+    if not isinstance(aWiki['priority'], (int, float)) or \
+      isinstance(aWiki['priority'], bool) :
+      wikiDie("The priority key MUST be a number", aWiki)
+
 def checkConfig(config : dict[str, Any]) -> None :
   checkTemplate(config)
   if 'host' not in config : config['host'] = "127.0.0.1"
@@ -130,6 +213,35 @@ def checkConfig(config : dict[str, Any]) -> None :
   checkDefaultHtml(config)
   checkStatic(config)
   if 'verbose' not in config : config['verbose'] = False
+  if 'indexTimeout' not in config : config['indexTimeout'] = 60
+  if 'serveStale' not in config : config['serveStale'] = False
+  if 'maxStaleness' not in config : config['maxStaleness'] = 0
+  if 'streamIndex' not in config : config['streamIndex'] = False
+  if 'gzipIndex' not in config : config['gzipIndex'] = True
+  if 'splitStore' not in config : config['splitStore'] = False
+  if 'changeLogSize' not in config : config['changeLogSize'] = 1000
+  if 'watchTiddlers' not in config : config['watchTiddlers'] = False
+  if 'watchDebounce' not in config : config['watchDebounce'] = 0.5
+  if 'watchPollInterval' not in config : config['watchPollInterval'] = 2
+  if 'rebuildQuietPeriod' not in config : config['rebuildQuietPeriod'] = 0.5
+  if 'rebuildMaxDelay' not in config : config['rebuildMaxDelay'] = 5
+  if 'packBackend' not in config : config['packBackend'] = 'thread'
+  if 'packProcesses' not in config : config['packProcesses'] = 2
+  if 'maxConcurrentPacks' not in config : config['maxConcurrentPacks'] = 2
+  if 'ioWorkers' not in config : config['ioWorkers'] = 8
+  if 'durability' not in config : config['durability'] = 'none'
+  if 'readWorkers' not in config : config['readWorkers'] = 1
+  if 'snapshotDir' not in config : config['snapshotDir'] = '.snapshots'
+  if config['snapshotDir'] :
+    config['snapshotDir'] = basePath(
+      cast(str, config['baseDir']), config['snapshotDir']
+    )
+  if 'snapshotInterval' not in config : config['snapshotInterval'] = 300
+  if 'preload' not in config : config['preload'] = 'eager'
+  if 'packedHtmlBudget' not in config : config['packedHtmlBudget'] = 0
+  if 'binaryTiddlers' not in config : config['binaryTiddlers'] = 'embedded'
+  if 'lazyTextSize' not in config : config['lazyTextSize'] = 0
+  if 'lazyTextTitles' not in config : config['lazyTextTitles'] = []
   checkWikis(config)
 
 def loadConfig(baseDir : str) -> dict[str,Any] :
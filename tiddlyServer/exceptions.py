@@ -5,3 +5,9 @@ class ExitNow(Exception) :
 
 shutDownExceptions = (ExitNow, KeyboardInterrupt, SystemExit)
 
+class PackCancelled(Exception) :
+  """
+  Raised (in a worker thread) when a pack, or a read of a tiddler
+  directory, has been superseded and so should stop as soon as possible.
+  """
+  pass
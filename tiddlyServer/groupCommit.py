@@ -0,0 +1,82 @@
+"""
+Flush the files written by concurrent requests to disk in batches (a
+"group commit"), so that many tiddler saves share the cost of each round
+of fsyncs.
+"""
+
+from typing import Iterable, Optional
+
+from pathlib import Path
+
+from anyio import to_thread, CancelScope, CapacityLimiter, Event
+
+from tiddlyServer.tiddlerSerDes import fsyncPathsBlocking
+
+class FsyncBatch :
+  """
+  The files (and directories) which will be flushed together.
+  """
+
+  paths : set[Path]
+  done  : Event
+  error : Optional[OSError]
+
+  def __init__(self) -> None :
+    self.paths = set()
+    self.done  = Event()
+    self.error = None
+
+class GroupCommitter :
+  """
+  Collects the files to be flushed to disk by concurrent requests.
+
+  The first request to arrive while no flush is in progress flushes every
+  file collected so far (in one worker thread), while the others wait for
+  that flush (or, if they arrived after it started, for the next one).
+
+  All methods MUST be called from the event loop.
+  """
+
+  pendingBatch : Optional[FsyncBatch]
+  """The batch still collecting files (if any)."""
+
+  flushingBatch : Optional[FsyncBatch]
+  """The batch being flushed (if any)."""
+
+  def __init__(self, limiter : Optional[CapacityLimiter] = None) -> None :
+    self.limiter       = limiter
+    self.pendingBatch  = None
+    self.flushingBatch = None
+
+  async def fsync(self, paths : Iterable[Path]) -> None :
+    """
+    Return once the given files (or directories) have been flushed to
+    disk, raising any :py:exc:`OSError` raised while flushing them.
+    """
+    if self.pendingBatch is None :
+      self.pendingBatch = FsyncBatch()
+    batch = self.pendingBatch
+    batch.paths.update(paths)
+
+    while not batch.done.is_set() :
+      if self.flushingBatch is not None :
+        await self.flushingBatch.done.wait()
+        continue
+      # nothing is being flushed... so flush everything collected so far
+      # (our batch, which, not yet flushed, is still the pending batch)
+      flushing = batch
+      self.pendingBatch  = None
+      self.flushingBatch = flushing
+      with CancelScope(shield=True) :
+        try :
+          await to_thread.run_sync(
+            fsyncPathsBlocking, sorted(flushing.paths), limiter=self.limiter
+          )
+        except OSError as err :
+          flushing.error = err
+        finally :
+          self.flushingBatch = None
+          flushing.done.set()
+
+    if batch.error is not None :
+      raise batch.error
@@ -0,0 +1,71 @@
+"""
+Share the (server wide) maxConcurrentPacks slots between the wikis which
+need to read or pack their tiddlers, so that (at startup) the wikis are
+loaded in priority order rather than all at once.
+"""
+
+from typing import AsyncIterator
+
+import contextlib
+
+from anyio import Event
+
+from starlette.applications import Starlette
+
+def packPriority(wikiApp : Starlette) -> tuple[int, float] :
+  # Wikis whose page is being waited on come first, then the wikis with
+  # the lowest priority (by default their position in the wikiOrder).
+  urgency = 0 if wikiApp.state.indexWaiters else 1
+  return (urgency, wikiApp.state.priority)
+
+class PackScheduler :
+  """
+  Hands out a fixed number of slots to the wikis waiting to read (or
+  pack) their tiddlers. Whenever a slot is freed it is given to the
+  waiting wiki with the best packPriority at that moment, so a wiki whose
+  page is requested while it waits jumps to the front of the queue.
+
+  All methods MUST be called from the event loop.
+  """
+
+  waiting : dict[Starlette, Event]
+  """The wikis waiting for a slot (each with the event which grants it)."""
+
+  def __init__(self, maxConcurrent : int) -> None :
+    self.maxConcurrent = max(1, maxConcurrent)
+    self.numRunning    = 0
+    self.waiting       = {}
+
+  async def acquire(self, wikiApp : Starlette) -> None :
+    if self.numRunning < self.maxConcurrent and not self.waiting :
+      self.numRunning += 1
+      return
+    granted = Event()
+    self.waiting[wikiApp] = granted
+    try :
+      await granted.wait()
+    except BaseException :
+      # a slot handed to us as we were cancelled is handed on
+      if granted.is_set() : self.release()
+      else : del self.waiting[wikiApp]
+      raise
+
+  def release(self) -> None :
+    if not self.waiting :
+      self.numRunning -= 1
+      return
+    # hand our slot straight to the most urgent waiting wiki
+    nextWikiApp = min(self.waiting, key=packPriority)
+    self.waiting.pop(nextWikiApp).set()
+
+  @contextlib.asynccontextmanager
+  async def slot(self, wikiApp : Starlette) -> AsyncIterator[None] :
+    """
+    Hold one of the slots (waiting, in priority order, for one to be
+    freed) for the duration of the `async with` block.
+    """
+    await self.acquire(wikiApp)
+    try :
+      yield
+    finally :
+      self.release()
@@ -1,26 +1,551 @@
 
+from typing import Optional
+
 import contextlib
-from datetime import datetime
+from datetime import datetime, timezone
+import gzip
+from hashlib import md5
+import io
+from pathlib import Path
+import time
 
-from anyio import create_task_group, Event, \
-  TASK_STATUS_IGNORED, to_thread, CancelScope, Lock
+from anyio import create_task_group, Event, CapacityLimiter, Lock, \
+  TASK_STATUS_IGNORED, to_thread, to_process, CancelScope, fail_after, sleep
 from anyio.abc import TaskStatus
 
 from starlette.applications import Starlette
 
-from tiddlyServer.tiddlerSerDes import packTiddlyWikiBlocking
-from tiddlyServer.exceptions import shutDownExceptions
+from tiddlyServer.tiddlerSerDes import packTiddlyWikiBlocking, \
+  packStoreScriptBlocking, CancelToken
+from tiddlyServer.tiddlerEmbedding import storeScriptPrefixes
+from tiddlyServer.tiddlerWatcher import createDirectoryWatcherBlocking
+from tiddlyServer.groupCommit import GroupCommitter
+from tiddlyServer.packScheduler import PackScheduler
+from tiddlyServer.snapshot import WikiSnapshot, htmlKeyBlocking, \
+  loadSnapshotBlocking, saveSnapshotBlocking
+from tiddlyServer.exceptions import shutDownExceptions, PackCancelled
 
 import logging
 
 logger = logging.getLogger('tiddlyWiki')
 
-def reloadTiddlyWiki(wikiApp) :
+class PackedStoreScript :
+  """
+  The (utf-8 encoded) store script of a wiki with a split store and,
+  optionally, a gzip compressed copy of the same script. The script is
+  served under a name which includes its contentHash, so that it can be
+  cached for ever.
+  """
+
+  script : bytes
+  scriptGzip : Optional[bytes]
+
+  contentHash : str
+  """The MD5 hash of the (uncompressed) script."""
+
+  def __init__(
+    self, script : bytes, scriptGzip : Optional[bytes], contentHash : str
+  ) -> None :
+    self.script      = script
+    self.scriptGzip  = scriptGzip
+    self.contentHash = contentHash
+
+  def etag(self, gzipped : bool = False) -> str :
+    if gzipped :
+      return f'"{self.contentHash}-gzip"'
+    return f'"{self.contentHash}"'
+
+def storeScriptName(contentHash : str) -> str :
+  # (the route, within the wiki's url, which serves the store script)
+  return f"store-{contentHash}.js"
+
+class PackedHtml :
+  """
+  The (utf-8 encoded) html of a packed wiki and, optionally, a gzip
+  compressed copy of the same html, together with the (strong) ETag and
+  Last-Modified time which identify this build.
+  """
+
+  html : bytes
+  htmlGzip : Optional[bytes]
+
+  contentHash : str
+  """The MD5 hash of the (uncompressed) html."""
+
+  lastModified : datetime
+  """The (UTC) time at which this content was first packed."""
+
+  storeScript : Optional[PackedStoreScript]
+  """The store script loaded by the html (of a wiki with a split store)."""
+
+  numBytes : int
+  """The memory used by the html (and its gzipped copy) and store script."""
+
+  def __init__(
+    self,
+    html : bytes,
+    htmlGzip : Optional[bytes],
+    contentHash : str,
+    lastModified : Optional[datetime] = None,
+    storeScript : Optional[PackedStoreScript] = None
+  ) -> None :
+    self.html         = html
+    self.htmlGzip     = htmlGzip
+    self.contentHash  = contentHash
+    if lastModified is None :
+      lastModified = datetime.now(timezone.utc).replace(microsecond=0)
+    self.lastModified = lastModified
+    self.storeScript  = storeScript
+    self.numBytes     = len(html) + len(htmlGzip or b'')
+    if storeScript is not None :
+      self.numBytes += len(storeScript.script)
+      self.numBytes += len(storeScript.scriptGzip or b'')
+
+  def etag(self, gzipped : bool = False) -> str :
+    # strong ETags MUST differ between the plain and gzipped html
+    if gzipped :
+      return f'"{self.contentHash}-gzip"'
+    return f'"{self.contentHash}"'
+
+compressBytesPerCheck = 1024 * 1024
+
+def compressBlocking(
+  data : bytes, cancelToken : Optional[CancelToken] = None
+) -> bytes :
+  # gzip the data a slice at a time so that we can stop part way through
+  if cancelToken is None :
+    return gzip.compress(data, mtime=0)
+  compressed = io.BytesIO()
+  with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as gzipFile :
+    for start in range(0, len(data), compressBytesPerCheck) :
+      cancelToken.check()
+      gzipFile.write(data[start:start + compressBytesPerCheck])
+  return compressed.getvalue()
+
+type PackedBytes = tuple[bytes, Optional[bytes], str]
+
+def packAndCompressBlocking(
+  emptyHtmlFilename : Path,
+  serialisedTiddlers : list[str],
+  wikiTitle : Optional[str],
+  compress : bool,
+  scriptTiddlers : Optional[list[str]] = None,
+  previousScriptHash : Optional[str] = None,
+  wikiUrl : str = "",
+  cancelToken : Optional[CancelToken] = None
+) -> tuple[PackedBytes, Optional[PackedBytes]] :
+  # Pack the wiki and (if asked) compress it, once per build, so that
+  # neither needs to be done on each request. Raises PackCancelled if the
+  # build is superseded part way through.
+  #
+  # If scriptTiddlers are given (for a wiki with a split store) they are
+  # packed into the store script which the html loads. The store script
+  # is only compressed (and returned) if it differs from the previous one.
+  #
+  # This is run either in a worker thread or (with no cancelToken) in a
+  # worker process, so it returns only bytes: the html, its gzipped copy
+  # and the html's MD5 hash (and the same for the store script, or None).
+  storeScriptUrl = None
+  packedScript = None
+  if scriptTiddlers is not None :
+    script = packStoreScriptBlocking(
+      emptyHtmlFilename, scriptTiddlers
+    ).encode('utf-8')
+    scriptHash = md5(script).hexdigest()
+    storeScriptUrl = f"{wikiUrl}/{storeScriptName(scriptHash)}"
+    if scriptHash != previousScriptHash :
+      scriptGzip = None
+      if compress :
+        scriptGzip = compressBlocking(script, cancelToken)
+      packedScript = (script, scriptGzip, scriptHash)
+  html = packTiddlyWikiBlocking(
+    emptyHtmlFilename, serialisedTiddlers, wikiTitle, cancelToken,
+    storeScriptUrl
+  ).encode('utf-8')
+  htmlGzip = None
+  if compress :
+    htmlGzip = compressBlocking(html, cancelToken)
+  if cancelToken : cancelToken.check()
+  return ((html, htmlGzip, md5(html).hexdigest()), packedScript)
+
+async def packTiddlyWiki(wikiApp, forced : bool) -> Optional[PackedHtml] :
+  # Pack the wiki's current fragments using the wiki's packBackend, once
+  # one of the (server wide) maxConcurrentPacks is free.
+  #
+  # Returns None if the pack was cancelled by reloadTiddlyWiki. The
+  # cancelPack may be a CancelToken (checked by the worker thread) or a
+  # CancelScope (which kills the worker process), both have a cancel
+  # method.
+  fragments = wikiApp.state.tiddlerStore.fragments
+  previousScript = wikiApp.state.storeScript
+  if wikiApp.state.splitStore :
+    pageTiddlers, scriptTiddlers = fragments.splitFragments(
+      storeScriptPrefixes
+    )
+  else :
+    pageTiddlers, scriptTiddlers = fragments.orderedFragments(), None
+  packArgs = (
+    wikiApp.state.emptyHtmlFilename,
+    pageTiddlers,
+    fragments.wikiTitle(),
+    wikiApp.state.gzipIndex,
+    scriptTiddlers,
+    previousScript.contentHash if previousScript else None,
+    wikiApp.state.wikiUrl
+  )
+  wikiApp.state.rebuildForced = forced
+  try :
+    if wikiApp.state.packBackend == 'process' :
+      with CancelScope() as cancelScope :
+        wikiApp.state.cancelPack = cancelScope
+        async with wikiApp.state.packScheduler.slot(wikiApp) :
+          packedBytes = await to_process.run_sync(
+            packAndCompressBlocking,
+            *packArgs,
+            cancellable=True,
+            limiter=wikiApp.state.processLimiter
+          )
+      if cancelScope.cancelled_caught : return None
+    else :
+      cancelToken = CancelToken()
+      wikiApp.state.cancelPack = cancelToken
+      try :
+        async with wikiApp.state.packScheduler.slot(wikiApp) :
+          packedBytes = await to_thread.run_sync(
+            packAndCompressBlocking,
+            *packArgs,
+            cancelToken,
+            abandon_on_cancel=True
+          )
+      except PackCancelled :
+        return None
+      finally :
+        # if we are being shut down, this stops the abandoned worker thread
+        cancelToken.cancel()
+  finally :
+    wikiApp.state.cancelPack = None
+    wikiApp.state.rebuildForced = False
+  htmlBytes, scriptBytes = packedBytes
+  if scriptBytes is not None :
+    # the previous store script is still needed by the pages served
+    # before this pack is swapped in
+    wikiApp.state.previousStoreScript = previousScript
+    wikiApp.state.storeScript = PackedStoreScript(*scriptBytes)
+  return PackedHtml(*htmlBytes, storeScript=wikiApp.state.storeScript)
+
+def packOptions(wikiApp) -> str :
+  # Identifies the wiki's options which change its packed html.
+  lazyText = wikiApp.state.tiddlerStore.lazyText
+  options = lazyText.key() if lazyText else ""
+  if wikiApp.state.splitStore : options += ":splitStore"
+  return options
+
+async def restoreSnapshot(wikiApp) -> bool :
+  # Restore the wiki's tiddlerStore (and, if none of its tiddler files nor
+  # its empty.html have changed, its packed html) from its snapshot.
+  # Returns False if there is no usable snapshot.
+  snapshotPath = wikiApp.state.snapshotPath
+  if snapshotPath is None : return False
+  snapshot = await to_thread.run_sync(
+    loadSnapshotBlocking, snapshotPath, wikiApp.state.tiddlerDir
+  )
+  if snapshot is None : return False
+
+  tiddlerStore = wikiApp.state.tiddlerStore
+  numChanged = await tiddlerStore.restore(
+    snapshot.tiddlers, snapshot.fileTitles, snapshot.fileStats
+  )
+  htmlKey = await to_thread.run_sync(
+    htmlKeyBlocking,
+    wikiApp.state.emptyHtmlFilename,
+    wikiApp.state.wikiUrl,
+    packOptions(wikiApp)
+  )
+  if numChanged == 0 and snapshot.html is not None and \
+    snapshot.htmlKey == htmlKey and not wikiApp.state.streamIndex :
+    if snapshot.storeScript is not None :
+      wikiApp.state.storeScript = PackedStoreScript(
+        snapshot.storeScript,
+        snapshot.storeScriptGzip if wikiApp.state.gzipIndex else None,
+        snapshot.storeScriptHash
+      )
+    wikiApp.state.packed = PackedHtml(
+      snapshot.html,
+      snapshot.htmlGzip if wikiApp.state.gzipIndex else None,
+      snapshot.contentHash,
+      snapshot.lastModified,
+      wikiApp.state.storeScript
+    )
+    wikiApp.state.packedGeneration   = tiddlerStore.generation
+    wikiApp.state.snapshotGeneration = tiddlerStore.generation
+    logger.info(f"restored the packed html of {wikiApp.state.name}")
+    wikiApp.state.packedCache.evictLeastRecentlyUsed(wikiApp)
+  elif numChanged == 0 and wikiApp.state.streamIndex :
+    # (the snapshot of a streamed wiki holds just its tiddlerStore)
+    wikiApp.state.snapshotGeneration = tiddlerStore.generation
+  return True
+
+def snapshotIsCurrent(wikiApp, generation : int) -> bool :
+  # Is the wiki still as it was when its snapshot (of this generation) was
+  # started? A wiki which streams its page is never packed, so its
+  # snapshot holds just its tiddlerStore.
+  if wikiApp.state.streamIndex :
+    return not wikiApp.state.storeNeedsRescan and \
+      wikiApp.state.tiddlerStore.generation == generation
+  return wikiIsFresh(wikiApp)
+
+async def saveSnapshot(wikiApp) -> None :
+  # Save a snapshot of the wiki's tiddlerStore and packed html (which MUST
+  # be fresh) unless the latest snapshot is already of this generation.
+  #
+  # A wiki's snapshots are saved one at a time, so a save (for example at
+  # shutdown) which waited for an earlier save of the same generation is
+  # skipped.
+  async with wikiApp.state.snapshotLock :
+    await saveSnapshotLocked(wikiApp)
+
+async def saveSnapshotLocked(wikiApp) -> None :
+  tiddlerStore = wikiApp.state.tiddlerStore
+  generation = wikiApp.state.packedGeneration
+  if wikiApp.state.streamIndex : generation = tiddlerStore.generation
+  if wikiApp.state.snapshotPath is None or \
+    wikiApp.state.snapshotGeneration == generation or \
+    not snapshotIsCurrent(wikiApp, generation) :
+    return
+  htmlKey = await to_thread.run_sync(
+    htmlKeyBlocking,
+    wikiApp.state.emptyHtmlFilename,
+    wikiApp.state.wikiUrl,
+    packOptions(wikiApp)
+  )
+  if not snapshotIsCurrent(wikiApp, generation) : return
+  packed = None if wikiApp.state.streamIndex else wikiApp.state.packed
+  storeScript = packed.storeScript if packed else None
+  # copy the store's (top level) contents, the tiddlers themselves are
+  # replaced (never changed) by the store
+  snapshot = WikiSnapshot(
+    dict(tiddlerStore.tiddlers),
+    dict(tiddlerStore.fileTitles),
+    dict(tiddlerStore.fileStats),
+    htmlKey,
+    packed.html if packed else None,
+    packed.htmlGzip if packed else None,
+    packed.contentHash if packed else "",
+    packed.lastModified if packed else datetime.now(timezone.utc),
+    storeScript.script if storeScript else None,
+    storeScript.scriptGzip if storeScript else None,
+    storeScript.contentHash if storeScript else ""
+  )
+  try :
+    await to_thread.run_sync(
+      saveSnapshotBlocking,
+      wikiApp.state.snapshotPath,
+      wikiApp.state.tiddlerDir,
+      snapshot
+    )
+  except OSError as err :
+    logger.warning(
+      f"could not save the snapshot of {wikiApp.state.name}: {repr(err)}"
+    )
+    return
+  wikiApp.state.snapshotGeneration = generation
+  wikiApp.state.snapshotSavedAt    = time.monotonic()
+  logger.info(f"saved a snapshot of {wikiApp.state.name}")
+
+async def saveSnapshotIfDue(wikiApp) -> None :
+  # Save a snapshot at most once every snapshotInterval seconds (the
+  # latest changes are always saved when the server is shut down).
+  savedAt = wikiApp.state.snapshotSavedAt
+  if savedAt is None or \
+    wikiApp.state.snapshotInterval <= time.monotonic() - savedAt :
+    await saveSnapshot(wikiApp)
+
+class PackedHtmlCache :
+  """
+  Keeps the packed html held by all wikis within the (server wide)
+  packedHtmlBudget by evicting the packed html of the least recently
+  requested wikis. An evicted wiki is repacked when its page is next
+  requested.
+
+  All methods MUST be called from the event loop.
+  """
+
+  budget : int
+  """The maximum number of bytes of packed html (0 for no limit)."""
+
+  def __init__(self, wikiApps : list[Starlette], budget : int) -> None :
+    self.wikiApps = wikiApps
+    self.budget   = budget
+
+  def numBytes(self) -> int :
+    return sum(
+      aWikiApp.state.packed.numBytes for aWikiApp in self.wikiApps
+      if aWikiApp.state.packed is not None
+    )
+
+  def evictLeastRecentlyUsed(self, keepWikiApp : Starlette) -> None :
+    """
+    Evict the packed html of the least recently requested wikis (other
+    than keepWikiApp, which has just been packed) until the packed html
+    of all wikis fits within the budget.
+    """
+    if self.budget <= 0 : return
+    numBytes = self.numBytes()
+    evictable = sorted(
+      [
+        aWikiApp for aWikiApp in self.wikiApps
+        if aWikiApp.state.packed is not None and aWikiApp is not keepWikiApp
+      ],
+      key=lambda aWikiApp : aWikiApp.state.lastRequested
+    )
+    for aWikiApp in evictable :
+      if numBytes <= self.budget : break
+      numBytes -= aWikiApp.state.packed.numBytes
+      aWikiApp.state.packed     = None
+      aWikiApp.state.packWanted = False
+      aWikiApp.state.storeScript         = None
+      aWikiApp.state.previousStoreScript = None
+      aWikiApp.state.evictions += 1
+      logger.info(f"evicted the packed html of {aWikiApp.state.name}")
+
+def reloadTiddlyWiki(wikiApp, rescanDisk : bool = False) :
+  # Called whenever the wiki's tiddlerStore may have changed. The
+  # preloader only repacks if the store's generation has moved.
   logger.info(f"forcing reload of {wikiApp.state.name}")
-  if wikiApp.state.cancelLoading :
-    wikiApp.state.cancelLoading.cancel()
+  if wikiApp.state.staleSince is None :
+    wikiApp.state.staleSince = datetime.now()
+  if rescanDisk :
+    wikiApp.state.storeNeedsRescan = True
+    # any rescan in progress may have missed these changes
+    if wikiApp.state.cancelRescan :
+      wikiApp.state.cancelRescan.cancel()
+  now = time.monotonic()
+  if wikiApp.state.firstTriggerTime is None :
+    wikiApp.state.firstTriggerTime = now
+  wikiApp.state.lastTriggerTime = now
+  wikiApp.state.rebuildTriggers += 1
+  # a pack which has been forced by the rebuildMaxDelay (or which has been
+  # running since it was due) is never cancelled, so that a continuous
+  # stream of changes can not starve the wiki
+  if wikiApp.state.cancelPack and rebuildIsOverdue(wikiApp) :
+    wikiApp.state.rebuildForced = True
+  if wikiApp.state.cancelPack and not wikiApp.state.rebuildForced :
+    wikiApp.state.cancelPack.cancel()
   wikiApp.state.wikiNeedsLoading.set()
 
+def rebuildIsOverdue(wikiApp) -> bool :
+  # Has the wiki's first unpacked change waited rebuildMaxDelay seconds?
+  firstTriggerTime = wikiApp.state.firstTriggerTime
+  if firstTriggerTime is None : return False
+  waitedFor = time.monotonic() - firstTriggerTime
+  return wikiApp.state.rebuildMaxDelay <= waitedFor
+
+def rebuildFinished(wikiApp, startedAt : float) -> None :
+  # The changes made before startedAt are now packed (or need no pack), so
+  # the rebuildMaxDelay runs from the first change made since then (if
+  # any). The firstTriggerTime is kept across cancelled packs.
+  if wikiApp.state.lastTriggerTime is None :
+    wikiApp.state.firstTriggerTime = None
+  else :
+    wikiApp.state.firstTriggerTime = max(
+      wikiApp.state.firstTriggerTime, startedAt
+    )
+
+async def waitForQuietTiddlyWiki(wikiApp) -> tuple[int, bool] :
+  # Wait until the wiki has had no changes for rebuildQuietPeriod seconds
+  # (but never for longer than rebuildMaxDelay seconds after its first
+  # unpacked change), so that a burst of changes causes just one rebuild.
+  #
+  # Returns the number of triggers absorbed and whether the rebuild was
+  # forced by the rebuildMaxDelay.
+  while wikiApp.state.lastTriggerTime is not None :
+    if rebuildIsOverdue(wikiApp) : break
+    now = time.monotonic()
+    quietFor  = now - wikiApp.state.lastTriggerTime
+    waitedFor = now - wikiApp.state.firstTriggerTime
+    if wikiApp.state.rebuildQuietPeriod <= quietFor : break
+    await sleep(min(
+      wikiApp.state.rebuildQuietPeriod - quietFor,
+      wikiApp.state.rebuildMaxDelay - waitedFor
+    ))
+  triggers = wikiApp.state.rebuildTriggers
+  wikiApp.state.rebuildTriggers = 0
+  wikiApp.state.lastTriggerTime = None
+  return (triggers, rebuildIsOverdue(wikiApp))
+
+def wikiLoadFinished(wikiApp) :
+  # wake up (and then replace) the wikiLoaded event
+  wikiApp.state.wikiLoaded.set()
+  wikiApp.state.wikiLoaded = Event()
+
+def wikiIsFresh(wikiApp) -> bool :
+  # Is the wiki's html packed from the current contents of its tiddlerStore?
+  return wikiApp.state.packed is not None and \
+    not wikiApp.state.storeNeedsRescan and \
+    wikiApp.state.packedGeneration == wikiApp.state.tiddlerStore.generation
+
+def wikiMayServeStale(wikiApp) -> bool :
+  # May we serve the last good html while the wiki is being repacked?
+  if not wikiApp.state.serveStale or wikiApp.state.packed is None :
+    return False
+  if wikiApp.state.maxStaleness <= 0 or wikiApp.state.staleSince is None :
+    return True
+  staleness = datetime.now() - wikiApp.state.staleSince
+  return staleness.total_seconds() <= wikiApp.state.maxStaleness
+
+def requestPackedTiddlyWiki(wikiApp) -> None :
+  # The wiki's page has been requested, so (re)pack a lazy (or evicted)
+  # wiki and keep its html in preference to that of less recently
+  # requested wikis.
+  wikiApp.state.lastRequested = time.monotonic()
+  if not wikiApp.state.packWanted :
+    logger.info(f"{wikiApp.state.name} requested")
+    wikiApp.state.packWanted = True
+    wikiApp.state.wikiNeedsLoading.set()
+
+async def waitForTiddlyWiki(wikiApp) -> bool :
+  # Wait (at most indexTimeout seconds) for the preloader to finish packing
+  # the wiki's html (or for html which may be served stale). Returns False
+  # if we timed out.
+  #
+  # While we wait, the wiki goes to the front of the packScheduler's queue.
+  wikiApp.state.indexWaiters += 1
+  try :
+    with fail_after(wikiApp.state.indexTimeout) :
+      requestPackedTiddlyWiki(wikiApp)
+      while not wikiIsFresh(wikiApp) and not wikiMayServeStale(wikiApp) :
+        await wikiApp.state.wikiLoaded.wait()
+        # (we may have been evicted while we waited)
+        requestPackedTiddlyWiki(wikiApp)
+  except TimeoutError :
+    return False
+  finally :
+    wikiApp.state.indexWaiters -= 1
+  return True
+
+async def loadTiddlerStore(wikiApp) -> bool :
+  # (Re)build the wiki's tiddlerStore, the first time from its snapshot
+  # (if it has one) and otherwise by rescanning its tiddler directory.
+  # Returns False if the rescan was cancelled by reloadTiddlyWiki.
+  wikiApp.state.storeNeedsRescan = False
+  if not wikiApp.state.storeLoaded.is_set() and \
+    await restoreSnapshot(wikiApp) :
+    wikiApp.state.storeLoaded.set()
+    return True
+  cancelToken = CancelToken()
+  wikiApp.state.cancelRescan = cancelToken
+  try :
+    await wikiApp.state.tiddlerStore.rescan(cancelToken)
+  except PackCancelled :
+    logger.info(f"cancelled rescan of {wikiApp.state.name}")
+    wikiApp.state.storeNeedsRescan = True
+    return False
+  finally :
+    cancelToken.cancel()
+    wikiApp.state.cancelRescan = None
+  wikiApp.state.storeLoaded.set()
+  return True
+
 async def preloadTiddlyWiki(
   wikiApp : Starlette, task_status: TaskStatus[None] = TASK_STATUS_IGNORED
 ) :
@@ -35,51 +560,202 @@ async def preloadTiddlyWiki(
     try :
       logger.info(f"Waiting to load {wikiApp.state.name}")
       await wikiApp.state.wikiNeedsLoading.wait()
-      wikiApp.state.cancelLoading = None
+      triggers, forced = await waitForQuietTiddlyWiki(wikiApp)
+      startedAt = time.monotonic()
+      # clear the event BEFORE loading so that any changes made while we
+      # load will ask for a further load
+      wikiApp.state.wikiNeedsLoading = Event()
       timeStart = datetime.now()
-      wasCancelled = False
-      logger.info(f"loading {wikiApp.state.name}")
-      async with wikiApp.state.htmlLock :
-        wikiApp.state.html = None
-        with CancelScope() as cancelScope :
-          wikiApp.state.cancelLoading = cancelScope
-          wikiApp.state.html = await to_thread.run_sync(
-            packTiddlyWikiBlocking,
-            wikiApp.state.emptyHtmlFilename,
-            wikiApp.state.tiddlerDir,
-            str(wikiApp.state.wikiUrl)
-          )
-      wikiApp.state.cancelLoading = None
-      wikiApp.state.wikiNeedsLoading = Event()  # essentially clear the event
+      if wikiApp.state.storeNeedsRescan :
+        # reading a wiki's tiddlers competes (for the disk and the GIL)
+        # with packing the other wikis, so it waits for a pack slot
+        async with wikiApp.state.packScheduler.slot(wikiApp) :
+          storeLoaded = await loadTiddlerStore(wikiApp)
+        if not storeLoaded :
+          wikiApp.state.cancelledBuilds += 1
+          wikiApp.state.wikiNeedsLoading.set()
+          continue
+      if wikiApp.state.streamIndex :
+        # a streamed page is built from the tiddlerStore on each request,
+        # so the wiki is never packed (nor kept in the packedCache)
+        logger.info(f"{wikiApp.state.name} streamed, not packed")
+        wikiApp.state.staleSince = None
+        rebuildFinished(wikiApp, startedAt)
+        wikiLoadFinished(wikiApp)
+        await saveSnapshotIfDue(wikiApp)
+        continue
+      if not wikiApp.state.packWanted :
+        # a lazy (or evicted) wiki is not packed until its page is requested
+        logger.info(f"{wikiApp.state.name} not packed until requested")
+        rebuildFinished(wikiApp, startedAt)
+        wikiLoadFinished(wikiApp)
+        continue
+      generation = wikiApp.state.tiddlerStore.generation
+      if wikiApp.state.packed is not None and \
+        generation == wikiApp.state.packedGeneration :
+        logger.info(
+          f"{wikiApp.state.name} unchanged (generation {generation}, {triggers} triggers)"  # noqa
+        )
+        wikiApp.state.staleSince = None
+        rebuildFinished(wikiApp, startedAt)
+        wikiLoadFinished(wikiApp)
+        continue
+      logger.info(
+        f"loading {wikiApp.state.name} (generation {generation}, {triggers} triggers{', forced' if forced else ''})"  # noqa
+      )
+      # the last good html is kept (and, if allowed, served) until the new
+      # html can be swapped in, even if this pack is cancelled
+      packed = await packTiddlyWiki(wikiApp, forced)
       timeTaken = datetime.now() - timeStart
-      if wasCancelled :
+      if packed is None :
         logger.info(
           f"cancelled loading {wikiApp.state.name} took {timeTaken}"
         )
+        wikiApp.state.cancelledBuilds += 1
         wikiApp.state.wikiNeedsLoading.set()
       else :
-        logger.info(f"loaded {wikiApp.state.name} took {timeTaken}")
-        wikiApp.state.wikiLoaded.set()
-        wikiApp.state.wikiLoaded = Event()
+        logger.info(
+          f"loaded {wikiApp.state.name} took {timeTaken} (absorbed {triggers} triggers)"  # noqa
+        )
+        oldPacked = wikiApp.state.packed
+        if oldPacked and oldPacked.contentHash == packed.contentHash :
+          # nothing visible has changed so keep the old Last-Modified time
+          packed.lastModified = oldPacked.lastModified
+        wikiApp.state.packed = packed
+        wikiApp.state.packedGeneration = generation
+        wikiApp.state.completedBuilds += 1
+        rebuildFinished(wikiApp, startedAt)
+        if generation == wikiApp.state.tiddlerStore.generation :
+          wikiApp.state.staleSince = None
+        else :
+          wikiApp.state.staleSince = timeStart
+        wikiApp.state.packedCache.evictLeastRecentlyUsed(wikiApp)
+        wikiLoadFinished(wikiApp)
+        await saveSnapshotIfDue(wikiApp)
     except shutDownExceptions :
       break
 
+async def watchTiddlyWiki(
+  wikiApp : Starlette, task_status: TaskStatus[None] = TASK_STATUS_IGNORED
+) :
+  # Watch the wiki's tiddler directory for changes made by anything other
+  # than this server. Bursts of changes (for example a git checkout) are
+  # collected until the directory has been quiet for watchDebounce
+  # seconds, and then applied to the tiddlerStore as a single change (and
+  # so a single rebuild).
+  task_status.started()
+  await wikiApp.state.storeLoaded.wait()
+  watcher = await to_thread.run_sync(
+    createDirectoryWatcherBlocking,
+    wikiApp.state.tiddlerDir,
+    wikiApp.state.watchPollInterval
+  )
+  try :
+    # any file changed after the initial load read it, but before the
+    # watcher was watching it, is found from the files' FileStats
+    missed = await to_thread.run_sync(
+      wikiApp.state.tiddlerStore.changedFilesBlocking
+    )
+    if missed :
+      numChanged = await wikiApp.state.tiddlerStore.refreshFiles(missed)
+      logger.info(
+        f"{len(missed)} files changed in {wikiApp.state.name} while the watcher started ({numChanged} tiddlers)"  # noqa
+      )
+      if numChanged :
+        reloadTiddlyWiki(wikiApp)
+    while True :
+      changes = await to_thread.run_sync(
+        watcher.readChangesBlocking, 1.0, abandon_on_cancel=True
+      )
+      if changes is not None and not changes : continue
+      while changes is not None :
+        moreChanges = await to_thread.run_sync(
+          watcher.readChangesBlocking,
+          wikiApp.state.watchDebounce,
+          abandon_on_cancel=True
+        )
+        if moreChanges is None : changes = None
+        elif not moreChanges : break
+        else : changes.update(moreChanges)
+
+      if changes is None :
+        logger.info(f"lost track of changes to {wikiApp.state.name}")
+        reloadTiddlyWiki(wikiApp, rescanDisk=True)
+        continue
+      numChanged = await wikiApp.state.tiddlerStore.refreshFiles(changes)
+      logger.info(
+        f"{len(changes)} files changed in {wikiApp.state.name} ({numChanged} tiddlers)"  # noqa
+      )
+      if numChanged :
+        reloadTiddlyWiki(wikiApp)
+  except shutDownExceptions :
+    pass
+  finally :
+    watcher.close()
+
 @contextlib.asynccontextmanager
 async def appLifespan(app):
   async with create_task_group() as tg :
     logger.info("App LifeSpan: Run at startup!")
-    for aWikiApp in app.state.wikiApps :
-      # with each app, add wikiLoaded, wikiNeedsLoading events
-      # assert the wikiNeedsLoading event
+    # the limits on packing are shared by all wikis
+    packScheduler = PackScheduler(app.state.maxConcurrentPacks)
+    processLimiter = CapacityLimiter(app.state.packProcesses)
+    ioLimiter = CapacityLimiter(app.state.ioWorkers)
+    groupCommitter = GroupCommitter(ioLimiter)
+    packedCache = PackedHtmlCache(
+      app.state.wikiApps, app.state.packedHtmlBudget
+    )
+    app.state.packedCache = packedCache
+    # the preloaders are started (and so queue for the packScheduler's
+    # slots) in priority order
+    wikiApps = sorted(
+      app.state.wikiApps, key=lambda aWikiApp : aWikiApp.state.priority
+    )
+    for aWikiApp in wikiApps :
+      # with each app, add wikiLoaded, wikiNeedsLoading, storeLoaded events
+      # assert the wikiNeedsLoading event (the first load also builds the
+      # in-memory tiddlerStore)
       # and then start the preloadTiddlyWiki for aWikiApp
-      aWikiApp.state.html = None
+      aWikiApp.state.packed = None
+      aWikiApp.state.packedGeneration = -1
+      aWikiApp.state.storeScript         = None
+      aWikiApp.state.previousStoreScript = None
+      aWikiApp.state.staleSince       = None
+      aWikiApp.state.rebuildTriggers  = 0
+      aWikiApp.state.firstTriggerTime = None
+      aWikiApp.state.lastTriggerTime  = None
+      aWikiApp.state.rebuildForced    = False
+      aWikiApp.state.cancelPack       = None
+      aWikiApp.state.snapshotGeneration = -1
+      aWikiApp.state.snapshotSavedAt    = None
+      aWikiApp.state.snapshotLock       = Lock()
+      aWikiApp.state.packScheduler    = packScheduler
+      aWikiApp.state.indexWaiters     = 0
+      aWikiApp.state.processLimiter   = processLimiter
+      aWikiApp.state.ioLimiter        = ioLimiter
+      aWikiApp.state.writeLock        = Lock()
+      aWikiApp.state.groupCommitter   = groupCommitter
+      aWikiApp.state.cancelRescan     = None
+      aWikiApp.state.completedBuilds  = 0
+      aWikiApp.state.cancelledBuilds  = 0
+      aWikiApp.state.packedCache      = packedCache
+      aWikiApp.state.lastRequested    = 0.0
+      aWikiApp.state.evictions        = 0
+      # a lazy wiki is neither read nor packed until it is first used
+      aWikiApp.state.packWanted = aWikiApp.state.preload == 'eager'
       aWikiApp.state.wikiNeedsLoading = Event()
       aWikiApp.state.wikiLoaded       = Event()
-      aWikiApp.state.htmlLock         = Lock()
-      aWikiApp.state.wikiNeedsLoading.set()
+      aWikiApp.state.storeLoaded      = Event()
+      aWikiApp.state.storeNeedsRescan = True
+      if aWikiApp.state.packWanted :
+        aWikiApp.state.wikiNeedsLoading.set()
       await tg.start(preloadTiddlyWiki, aWikiApp)
+      if aWikiApp.state.watchTiddlers :
+        await tg.start(watchTiddlyWiki, aWikiApp)
     yield
     logger.info("App LifeSpan: Run on shutdown!")
+    for aWikiApp in app.state.wikiApps :
+      await saveSnapshot(aWikiApp)
     tg.cancel_scope.cancel()
   logger.info("App LifeSpane: All shutdown")
 
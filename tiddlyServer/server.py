@@ -111,7 +111,7 @@ def main():
       CORSMiddleware(
         app=baseApp,
         allow_origins=['*'],
-        allow_methods=['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS']
+        allow_methods=['GET', 'HEAD', 'PUT', 'POST', 'DELETE', 'OPTIONS']
       ),
       host=config['host'],
       port=int(config['port'])
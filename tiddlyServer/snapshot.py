@@ -0,0 +1,210 @@
+"""
+Save (and restore) a snapshot of a wiki's tiddlerStore and packed html, so
+that a restarted server can serve its wikis without first reading every
+tiddler file and repacking every wiki.
+
+A wiki's snapshot is kept in two files (which MUST NOT be in the wiki's
+tiddler directory): `<snapshot>.json` holds the tiddlers together with a
+manifest of the files (and their FileStats) they were read from, while
+`<snapshot>.html.gz` holds the (gzip compressed) packed html and (for a
+wiki with a split store) `<snapshot>.store.js.gz` holds its store script.
+"""
+
+from typing import Any, Optional
+
+from datetime import datetime
+import gzip
+from hashlib import md5
+import json
+import logging
+from pathlib import Path
+import zlib
+
+from tiddlyServer.types import Tiddler, FileStat
+from tiddlyServer.tiddlerSerDes import tempFilename
+
+logger = logging.getLogger('tiddlyWiki')
+
+snapshotVersion = 1
+
+class WikiSnapshot :
+  """
+  The contents of a wiki's tiddlerStore (and its packed html) at the time
+  the snapshot was taken.
+  """
+
+  tiddlers   : dict[str, Tiddler]
+  fileTitles : dict[Path, str]
+  fileStats  : dict[Path, FileStat]
+
+  htmlKey : str
+  """Identifies the empty.html (and wiki url) the html was packed with."""
+
+  html         : Optional[bytes]
+  htmlGzip     : Optional[bytes]
+  contentHash  : str
+  lastModified : datetime
+
+  storeScript     : Optional[bytes]
+  storeScriptGzip : Optional[bytes]
+  storeScriptHash : str
+  """The store script loaded by the html ("" if the store is not split)."""
+
+  def __init__(
+    self,
+    tiddlers : dict[str, Tiddler],
+    fileTitles : dict[Path, str],
+    fileStats : dict[Path, FileStat],
+    htmlKey : str,
+    html : Optional[bytes],
+    htmlGzip : Optional[bytes],
+    contentHash : str,
+    lastModified : datetime,
+    storeScript : Optional[bytes] = None,
+    storeScriptGzip : Optional[bytes] = None,
+    storeScriptHash : str = ""
+  ) -> None :
+    self.tiddlers     = tiddlers
+    self.fileTitles   = fileTitles
+    self.fileStats    = fileStats
+    self.htmlKey      = htmlKey
+    self.html         = html
+    self.htmlGzip     = htmlGzip
+    self.contentHash  = contentHash
+    self.lastModified = lastModified
+    self.storeScript     = storeScript
+    self.storeScriptGzip = storeScriptGzip
+    self.storeScriptHash = storeScriptHash
+
+def htmlKeyBlocking(
+  emptyHtmlFilename : Path, wikiUrl : str, packOptions : str = ""
+) -> str :
+  """
+  Return a key which changes whenever html packed for this wiki would
+  change even though none of its tiddlers have (because its empty.html,
+  url or packOptions have changed).
+  """
+  aStat = emptyHtmlFilename.stat()
+  return f"{wikiUrl}:{aStat.st_mtime_ns}:{aStat.st_size}:{packOptions}"
+
+def snapshotFile(snapshotPath : Path, suffix : str) -> Path :
+  return snapshotPath.with_name(snapshotPath.name + suffix)
+
+def writeAtomicallyBlocking(filename : Path, data : bytes) -> None :
+  tempFile = tempFilename(filename)
+  try :
+    tempFile.write_bytes(data)
+    tempFile.replace(filename)
+  except BaseException :
+    tempFile.unlink(missing_ok=True)
+    raise
+
+def saveSnapshotBlocking(
+  snapshotPath : Path, directory : Path, snapshot : WikiSnapshot
+) -> None :
+  """
+  Save the snapshot of the wiki whose tiddlers are in the given directory.
+
+  Only files whose FileStat is known are listed in the manifest (any other
+  files will be re-read when the snapshot is restored).
+  """
+  htmlGzip = snapshot.htmlGzip
+  if htmlGzip is None and snapshot.html is not None :
+    htmlGzip = gzip.compress(snapshot.html, mtime=0)
+  storeScriptGzip = snapshot.storeScriptGzip
+  if storeScriptGzip is None and snapshot.storeScript is not None :
+    storeScriptGzip = gzip.compress(snapshot.storeScript, mtime=0)
+
+  manifest : list[list[Any]] = []
+  for aFilename, aTitle in snapshot.fileTitles.items() :
+    aStat = snapshot.fileStats.get(aFilename)
+    if aStat is None : continue
+    manifest.append([
+      str(aFilename.relative_to(directory)), aTitle, list(aStat)
+    ])
+
+  snapshotPath.parent.mkdir(parents=True, exist_ok=True)
+  # the html is written first, the .json names the html it goes with
+  if storeScriptGzip is not None :
+    writeAtomicallyBlocking(
+      snapshotFile(snapshotPath, ".store.js.gz"), storeScriptGzip
+    )
+  if htmlGzip is not None :
+    writeAtomicallyBlocking(
+      snapshotFile(snapshotPath, ".html.gz"), htmlGzip
+    )
+  writeAtomicallyBlocking(
+    snapshotFile(snapshotPath, ".json"),
+    json.dumps({
+      'version'      : snapshotVersion,
+      'htmlKey'      : snapshot.htmlKey,
+      'contentHash'  : snapshot.contentHash,
+      'storeScriptHash' : snapshot.storeScriptHash,
+      'lastModified' : snapshot.lastModified.isoformat(),
+      'files'        : manifest,
+      'tiddlers'     : list(snapshot.tiddlers.values()),
+    }).encode('utf-8')
+  )
+
+def loadSnapshotBlocking(
+  snapshotPath : Path, directory : Path
+) -> Optional[WikiSnapshot] :
+  """
+  Load the snapshot of the wiki whose tiddlers are in the given directory.
+
+  Returns None if there is no (usable) snapshot. If the snapshot's html (or
+  store script) is missing (or does not match the snapshot) only the html
+  (and store script) are None.
+  """
+  jsonFilename = snapshotFile(snapshotPath, ".json")
+  if not jsonFilename.is_file() : return None
+  try :
+    data = json.loads(jsonFilename.read_bytes())
+    if data['version'] != snapshotVersion :
+      logger.info(f"ignoring old snapshot {jsonFilename}")
+      return None
+    tiddlers : dict[str, Tiddler] = {
+      aTiddler['title'] : aTiddler for aTiddler in data['tiddlers']
+    }
+    fileTitles : dict[Path, str] = {}
+    fileStats : dict[Path, FileStat] = {}
+    for aRelPath, aTitle, aStat in data['files'] :
+      aFilename = directory / aRelPath
+      fileTitles[aFilename] = aTitle
+      fileStats[aFilename] = tuple(aStat)
+    lastModified = datetime.fromisoformat(data['lastModified'])
+    htmlKey = data['htmlKey']
+    contentHash = data['contentHash']
+    storeScriptHash = data.get('storeScriptHash', "")
+  except (OSError, ValueError, KeyError, TypeError) as err :
+    logger.warning(f"could not load snapshot {jsonFilename}: {repr(err)}")
+    return None
+
+  html = None
+  htmlGzip = None
+  try :
+    htmlGzip = snapshotFile(snapshotPath, ".html.gz").read_bytes()
+    html = gzip.decompress(htmlGzip)
+    if md5(html).hexdigest() != contentHash :
+      html = htmlGzip = None
+  except (OSError, EOFError, zlib.error) :
+    html = htmlGzip = None
+
+  storeScript = None
+  storeScriptGzip = None
+  if html is not None and storeScriptHash :
+    try :
+      storeScriptGzip = snapshotFile(
+        snapshotPath, ".store.js.gz"
+      ).read_bytes()
+      storeScript = gzip.decompress(storeScriptGzip)
+      if md5(storeScript).hexdigest() != storeScriptHash :
+        html = htmlGzip = storeScript = storeScriptGzip = None
+    except (OSError, EOFError, zlib.error) :
+      html = htmlGzip = storeScript = storeScriptGzip = None
+
+  return WikiSnapshot(
+    tiddlers, fileTitles, fileStats,
+    htmlKey, html, htmlGzip, contentHash, lastModified,
+    storeScript, storeScriptGzip, storeScriptHash
+  )
@@ -2,8 +2,10 @@
 Routines for inserting tiddlers into an ``empty.html`` TiddlyWiki file.
 """
 
-from typing import Optional, cast
+from typing import Iterator, Optional
 
+from bisect import bisect_left
+from fnmatch import fnmatchcase
 from html import escape
 from html.parser import HTMLParser
 import json
@@ -57,9 +59,10 @@ class HTMLTagOffsetFinder(HTMLParser):
 
   def feed(self, string: str) -> None:
     # Find the line start offsets for this batch of data
-    for i, c in enumerate(string):
-      if c == "\n":
-        self._lineno_to_offset.append(self._chars_fed + i + 1)
+    i = string.find("\n")
+    while i >= 0:
+      self._lineno_to_offset.append(self._chars_fed + i + 1)
+      i = string.find("\n", i + 1)
     self._chars_fed += len(string)
 
     super().feed(string)
@@ -90,58 +93,6 @@ class HTMLTagOffsetFinder(HTMLParser):
       if tag == target_tag and target_attrs.issubset(attrs):
         matches.append((tag, dict(attrs), start_offset, end_offset))
 
-def modify_string(
-  string: str,
-  insertions: list[tuple[int, str]] = [],
-  deletions: list[tuple[int, int]] = [],
-) -> str:
-  """
-  Modify a string by inserting new substrings at a provided set of offsets
-  and by deleting defined regions of the string.
-
-  Deletion ranges must not overlap eachother or insertion points. Multiple
-  values may be inserted at a given point and will be inserted one after
-  another in the order given in that case.
-  """
-  ranges = sorted([(i, i) for i, s in insertions] + deletions)
-  for (s1, e1), (s2, e2) in zip(ranges[:-1], ranges[1:]):
-    if s2 < e1:
-      raise ValueError("Overlapping insertions or deletions")
-
-  parts = []
-  changes : list[tuple[int, int | str]] = []
-  changes = cast(list[tuple[int, int | str]], deletions) + \
-    cast(list[tuple[int, int | str]], insertions[::-1])
-  for change in sorted(changes, key=lambda x: x[0], reverse=True):  # noqa
-    if isinstance(change[1], str):  # Insertion
-      offset, substring = change
-      parts.append(string[offset:])
-      parts.append(cast(str, substring))
-      string = string[:offset]
-    else:  # Deletion
-      start, end = change
-      parts.append(string[cast(int, end):])
-      string = string[:start]
-  parts.append(string)
-  return "".join(reversed(parts))
-
-def getTitleAndSubtitle(
-  tiddlers: Tiddlers
-) -> tuple[Optional[str], Optional[str]]:
-  """
-  Get the wiki title and subtitles defined in the given set of tiddlers (if a
-  custom title/subtitle is defined).
-  """
-  title: Optional[str] = None
-  subtitle: Optional[str] = None
-  for tiddler in tiddlers:
-    if tiddler.get("title") == "$:/SiteTitle":
-      title = tiddler.get("text")
-    elif tiddler.get("title") == "$:/SiteSubtitle":
-      subtitle = tiddler.get("text")
-
-  return (title, subtitle)
-
 def serialiseAsJsonTiddler(tiddler: Tiddler) -> str:
   """
   Given a Tiddler, return the JSON for the 'tiddlywiki-tiddler-store'
@@ -169,78 +120,406 @@ class UnexpectedHTMLStructureError(ValueError):
   version supplied?
   """
 
-def embedTiddlersIntoEmptyHtml(
-  html: str, tiddlers: Tiddlers
-) -> str:
+def checkForRawMarkup(tiddler : Tiddler) -> None :
+  """
+  Log an error if the tiddler is an (unsupported) RawMarkup tiddler (which
+  we can't embed by just stuffing it in to the store area).
+  """
+  if "$:/tags/RawMarkup" in tiddler.get("tags", ""):
+    logging.error(
+      f"Could not correctly render RawMarkup tiddler {tiddler.get('title', '')}"  # noqa
+    )
+
+def combineTitleAndSubtitle(
+  title : Optional[str], subtitle : Optional[str]
+) -> Optional[str] :
+  """
+  Combine the wiki title and subtitle into the text of the <title> tag (or
+  None if the empty.html's title should be left unchanged).
+  """
+  if title is not None and subtitle is not None:
+    title += f" \N{EM DASH} {subtitle}"
+  return title
+
+class LazyText :
+  """
+  Decides which tiddlers are embedded without their text (as "skinny"
+  tiddlers, which TiddlyWiki's syncer loads from the server the first time
+  their text is needed).
+
+  System (`$:/...`) tiddlers are always embedded in full.
+  """
+
+  minSize : int
+  """The length of text (0 for none) above which a tiddler is skinny."""
+
+  titlePatterns : list[str]
+  """Glob patterns (see fnmatch) of the titles of skinny tiddlers."""
+
+  def __init__(
+    self, minSize : int = 0, titlePatterns : list[str] = []
+  ) -> None :
+    self.minSize       = minSize
+    self.titlePatterns = list(titlePatterns)
+
+  def isSkinny(self, tiddler : Tiddler) -> bool :
+    title = tiddler.get("title", "")
+    if title.startswith("$:/") or not tiddler.get("text") :
+      return False
+    if 0 < self.minSize < len(tiddler["text"]) :
+      return True
+    return any(
+      fnmatchcase(title, aPattern) for aPattern in self.titlePatterns
+    )
+
+  def key(self) -> str :
+    """
+    Identifies these settings (which change the packed html).
+    """
+    return json.dumps([self.minSize, self.titlePatterns])
+
+def serialiseFragment(
+  tiddler : Tiddler, lazyText : Optional[LazyText] = None
+) -> str :
+  """
+  Serialise a tiddler to be embedded (without its text if the lazyText
+  says it should be skinny).
+  """
+  if lazyText is not None and lazyText.isSkinny(tiddler) :
+    aSkinnyTiddler = tiddler.copy()
+    aSkinnyTiddler.pop("text")
+    aSkinnyTiddler["_is_skinny"] = ""
+    return serialiseAsJsonTiddler(aSkinnyTiddler)
+  return serialiseAsJsonTiddler(tiddler)
+
+class TiddlerFragments :
+  """
+  The serialised (JSON) form of each tiddler of a wiki, kept in title order,
+  so that a wiki can be repacked without re-serialising (or re-sorting) any
+  of the tiddlers which have not changed.
+
+  Extra tiddlers are only embedded if no tiddler with the same title has
+  been put.
+  """
+
+  titles : list[str]
+  """The titles of all tiddlers in sorted order."""
+
+  fragments : list[str]
+  """The serialised tiddlers in the same order as the titles."""
+
+  extraFragments : dict[str, str]
+  """The serialised extra tiddlers keyed by title."""
+
+  siteTitle : Optional[str]
+  siteSubtitle : Optional[str]
+
+  lazyText : Optional[LazyText]
+  """Which tiddlers are embedded without their text (if any)."""
+
+  def __init__(
+    self,
+    extraTiddlers : Tiddlers = [],
+    lazyText : Optional[LazyText] = None
+  ) -> None :
+    self.titles         = []
+    self.fragments      = []
+    self.extraFragments = {}
+    self.siteTitle      = None
+    self.siteSubtitle   = None
+    self.lazyText       = lazyText
+    for aTiddler in extraTiddlers :
+      title = aTiddler.get("title", "")
+      self.extraFragments[title] = serialiseAsJsonTiddler(aTiddler)
+      self._setFragment(title, self.extraFragments[title])
+
+  def _setFragment(self, title : str, fragment : str) -> None :
+    index = bisect_left(self.titles, title)
+    if index < len(self.titles) and self.titles[index] == title :
+      self.fragments[index] = fragment
+    else :
+      self.titles.insert(index, title)
+      self.fragments.insert(index, fragment)
+
+  def _deleteFragment(self, title : str) -> None :
+    index = bisect_left(self.titles, title)
+    if index < len(self.titles) and self.titles[index] == title :
+      del self.titles[index]
+      del self.fragments[index]
+
+  def _noteSiteTitle(self, title : str, text : Optional[str]) -> None :
+    if title == "$:/SiteTitle" :
+      self.siteTitle = text
+    elif title == "$:/SiteSubtitle" :
+      self.siteSubtitle = text
+
+  def putTiddler(self, tiddler : Tiddler) -> None :
+    """
+    Add (or replace) the fragment of one tiddler.
+    """
+    title = tiddler.get("title", "")
+    checkForRawMarkup(tiddler)
+    self._setFragment(title, serialiseFragment(tiddler, self.lazyText))
+    self._noteSiteTitle(title, tiddler.get("text"))
+
+  def putTiddlers(self, tiddlers : Tiddlers) -> None :
+    """
+    Add (or replace) the fragments of many tiddlers, sorting only once.
+    """
+    fragments = dict(zip(self.titles, self.fragments))
+    for aTiddler in tiddlers :
+      title = aTiddler.get("title", "")
+      checkForRawMarkup(aTiddler)
+      fragments[title] = serialiseFragment(aTiddler, self.lazyText)
+      self._noteSiteTitle(title, aTiddler.get("text"))
+    self.titles = sorted(fragments)
+    self.fragments = [ fragments[aTitle] for aTitle in self.titles ]
+
+  def removeTiddler(self, title : str) -> None :
+    """
+    Remove the fragment of one tiddler (reverting to any extra tiddler).
+    """
+    if title in self.extraFragments :
+      self._setFragment(title, self.extraFragments[title])
+    else :
+      self._deleteFragment(title)
+    self._noteSiteTitle(title, None)
+
+  def orderedFragments(self) -> list[str] :
+    """
+    Return a snapshot of the serialised tiddlers, in title order, which can
+    be safely handed to a worker thread.
+    """
+    return self.fragments.copy()
+
+  def splitFragments(
+    self, prefixes : tuple[str, ...]
+  ) -> tuple[list[str], list[str]] :
+    """
+    Return snapshots (see :py:meth:`orderedFragments`) of the serialised
+    tiddlers whose titles do not, and of those which do, start with any of
+    the prefixes.
+    """
+    others : list[str] = []
+    matching : list[str] = []
+    for aTitle, aFragment in zip(self.titles, self.fragments) :
+      if aTitle.startswith(prefixes) :
+        matching.append(aFragment)
+      else :
+        others.append(aFragment)
+    return (others, matching)
+
+  def wikiTitle(self) -> Optional[str] :
+    return combineTitleAndSubtitle(self.siteTitle, self.siteSubtitle)
+
+# The titles of the (plugin and other rarely changing system) tiddlers
+# which a split store moves into the wiki's store script
+storeScriptPrefixes = ("$:/core", "$:/plugins/", "$:/themes/", "$:/languages/")
+
+class EmptyHtmlTemplate :
+  """
+  The HTML of an empty TiddlyWiki, pre-split at the places which are changed
+  when tiddlers are embedded (the <title>, the Javascript disabled message
+  and the end of the tiddler store area), so that tiddlers can be embedded
+  without re-parsing the (multi-megabyte) HTML.
+
+  A template with a split store keeps only those of the empty.html's own
+  tiddlers whose titles do not start with any of the storeScriptPrefixes
+  in its store area, which is followed by the <script> tag which loads the
+  (separately packed) store script holding all of the other tiddlers.
+  """
+
+  segments : list[str]
+  """
+  The unchanged parts of the HTML. There is always one more segment than
+  there are slots.
+  """
+
+  slots : list[str]
   """
-  Given the HTML of an empty TiddlyWiki, embed the provided tiddlers.
+  What to place between each pair of segments: one of "title", "noscript"
+  or "store".
   """
-  # Find the <title> tag, Javascript disabled message (which contains a stale
-  # list of tiddlers) and tiddler store area.
-  finder = HTMLTagOffsetFinder(
-    [
-      ("title", {}),
-      ("noscript", {}),
-      ("script", {"class": "tiddlywiki-tiddler-store"}),
-      # ("div", {"id": "storeArea"}),
+
+  originalTitle : str
+  """The contents of the empty.html's <title> tag."""
+
+  pageBuiltins : list[str]
+  """The empty.html's (serialised) tiddlers kept in a split store area."""
+
+  scriptBuiltins : list[str]
+  """The empty.html's (serialised) tiddlers moved to the store script."""
+
+  def __init__(
+    self,
+    segments : list[str],
+    slots : list[str],
+    originalTitle : str,
+    pageBuiltins : Optional[list[str]] = None,
+    scriptBuiltins : Optional[list[str]] = None
+  ) -> None :
+    self.segments       = segments
+    self.slots          = slots
+    self.originalTitle  = originalTitle
+    self.pageBuiltins   = pageBuiltins or []
+    self.scriptBuiltins = scriptBuiltins or []
+
+  @classmethod
+  def fromHtml(
+    cls, html : str, splitStore : bool = False
+  ) -> "EmptyHtmlTemplate" :
+    """
+    Parse the HTML of an empty TiddlyWiki (splitting its store area out, if
+    splitStore is True).
+    """
+    # Find the <title> tag, Javascript disabled message (which contains a
+    # stale list of tiddlers) and tiddler store area.
+    finder = HTMLTagOffsetFinder(
+      [
+        ("title", {}),
+        ("noscript", {}),
+        ("script", {"class": "tiddlywiki-tiddler-store"}),
+        # ("div", {"id": "storeArea"}),
+      ]
+    )
+    finder.feed(html)
+    if len(finder.matches[0]) != 1:
+      raise UnexpectedHTMLStructureError("Expected exactly one <title>")
+    if len(finder.matches[1]) != 1:
+      raise UnexpectedHTMLStructureError("Expected exactly one <noscript>")
+    if len(finder.matches[2]) != 1:
+      raise UnexpectedHTMLStructureError("Expected exactly one store area")
+    _tag, _attrs, title_start, title_end = finder.matches[0][0]
+    _tag, _attrs, noscript_start, noscript_end = finder.matches[1][0]
+    _tag, _attrs, store_area_start, store_area_end = finder.matches[2][0]
+
+    # In the v5.2.x style tiddler store, the end of the "tiddler store" (an
+    # array of JSON encoded strings separated by commas and on their own
+    # lines) IS NOT the start of the `</srcipt>` tag but is actually two
+    # characters (a space/newline and a `]`) BEFORE the `</script> end tag.
+    changes = [
+      (title_start, title_end, "title"),
+      (noscript_start, noscript_end, "noscript"),
     ]
-  )
-  finder.feed(html)
-  if len(finder.matches[0]) != 1:
-    raise UnexpectedHTMLStructureError("Expected exactly one <title>")
-  if len(finder.matches[1]) != 1:
-    raise UnexpectedHTMLStructureError("Expected exactly one <noscript>")
-  if len(finder.matches[2]) != 1:
-    raise UnexpectedHTMLStructureError("Expected exactly one store area")
-  _tag, _attrs, title_start, title_end = finder.matches[0][0]
-  _tag, _attrs, noscript_start, noscript_end = finder.matches[1][0]
-  _tag, _attrs, _store_area_start, store_area_end = finder.matches[2][0]
-
-  insertions = []
-  deletions = []
-
-  # Change <title> as necessary
-  title, subtitle = getTitleAndSubtitle(tiddlers)
-  if title is not None:
-    if subtitle is not None:
-      title += f" \N{EM DASH} {subtitle}"
-    deletions.append((title_start, title_end))
-    insertions.append((title_start, title))
-
-  # Remove noscript content (arguably we should add the tiddler title list
-  # but, honestly, I can't be bothered right now...
-  deletions.append((noscript_start, noscript_end))
-  insertions.append((noscript_start,  "Please enable Javascript"))
-
-  # Check for (unsupported) RawMarkup tiddlers (which we can't embed by just
-  # stuffing them in to the store area).
-  for tiddler in tiddlers:
-    if "$:/tags/RawMarkup" in tiddler.get("tags", ""):
-      logging.error(
-        f"Could not correctly render RawMarkup tiddler {tiddler.get('title', '')}"  # noqa
-      )
-
-  # Add tiddlers
-  #
-  # In the v5.2.x style tiddler store, each tiddler MUST be separated by a
-  # comma and be on a line of its own.
-  #
-  def sortByTitle(aTiddler : Tiddler ) -> str :
-    return aTiddler.get("title", "")
-  serialised_tiddlers = []
-  for aTiddler in  sorted(tiddlers, key=sortByTitle) :
-    serialised_tiddlers.append(serialiseAsJsonTiddler(aTiddler))
-  serialised_tiddlers_str = ",\n".join(serialised_tiddlers)
-  #
-
-  # In the v5.2.x style tiddler store, the end of the "tiddler store" (an
-  # array of JSON encoded strings separated by commas and on their own
-  # lines) IS NOT the start of the `</srcipt>` tag but is actually two
-  # characters (a space/newline and a `]`) BEFORE the `</script> end tag.
-
-  insertions.append((store_area_end - 2, ',\n' + serialised_tiddlers_str))
-
-  return modify_string(html, insertions, deletions)
+    if splitStore :
+      # replace the whole store area and load the store script straight
+      # after it (and so before TiddlyWiki boots)
+      store_tag_end = html.index(">", store_area_end) + 1
+      changes.append((store_area_start, store_area_end, "storeArray"))
+      changes.append((store_tag_end, store_tag_end, "storeScript"))
+    else :
+      changes.append((store_area_end - 2, store_area_end - 2, "store"))
+    changes.sort()
+    pageBuiltins : list[str] = []
+    scriptBuiltins : list[str] = []
+    if splitStore :
+      try :
+        builtins = json.loads(html[store_area_start:store_area_end])
+      except ValueError as err :
+        raise UnexpectedHTMLStructureError(
+          f"Could not parse the store area: {err}"
+        )
+      for aTiddler in builtins :
+        if aTiddler.get("title", "").startswith(storeScriptPrefixes) :
+          scriptBuiltins.append(serialiseAsJsonTiddler(aTiddler))
+        else :
+          # (as TiddlyWiki does, so that no text can end the <script> tag)
+          pageBuiltins.append(
+            serialiseAsJsonTiddler(aTiddler).replace("<", "\\u003C")
+          )
+    for (s1, e1, _slot1), (s2, e2, _slot2) in zip(changes[:-1], changes[1:]):
+      if s2 < e1:
+        raise UnexpectedHTMLStructureError("Overlapping tags")
+
+    segments = []
+    slots = []
+    offset = 0
+    for start, end, slot in changes :
+      segments.append(html[offset:start])
+      slots.append(slot)
+      offset = end
+    segments.append(html[offset:])
+
+    return cls(
+      segments, slots, html[title_start:title_end],
+      pageBuiltins, scriptBuiltins
+    )
+
+  def iterParts(
+    self,
+    serialisedTiddlers : list[str],
+    title : Optional[str],
+    tiddlersPerPart : int = 0,
+    storeScriptUrl : str = ""
+  ) -> Iterator[str] :
+    """
+    Yield the parts which, when joined, are the HTML with the provided
+    (already serialised and sorted) tiddlers embedded and (if not None) the
+    wiki's title replaced.
+
+    If tiddlersPerPart is greater than zero, the tiddlers are yielded in
+    parts of (at most) that many tiddlers, otherwise they are yielded as
+    one part.
+
+    A template with a split store loads its store script from the
+    storeScriptUrl.
+    """
+    if tiddlersPerPart < 1 :
+      tiddlersPerPart = max(len(serialisedTiddlers), 1)
+    yield self.segments[0]
+    for slot, segment in zip(self.slots, self.segments[1:]) :
+      if slot == "title" :
+        yield self.originalTitle if title is None else title
+      elif slot == "noscript" :
+        # Remove noscript content (arguably we should add the tiddler title
+        # list but, honestly, I can't be bothered right now...
+        yield "Please enable Javascript"
+      elif slot == "storeArray" :
+        separator = '[\n'
+        if self.pageBuiltins :
+          yield separator + ",\n".join(self.pageBuiltins)
+          separator = ',\n'
+        for start in range(0, len(serialisedTiddlers), tiddlersPerPart) :
+          yield separator + ",\n".join(
+            serialisedTiddlers[start:start + tiddlersPerPart]
+          )
+          separator = ',\n'
+        yield '[]' if separator == '[\n' else '\n]'
+      elif slot == "storeScript" :
+        yield f'\n<script src="{escape(storeScriptUrl)}"></script>'
+      else :
+        # In the v5.2.x style tiddler store, each tiddler MUST be separated
+        # by a comma and be on a line of its own.
+        for start in range(0, len(serialisedTiddlers), tiddlersPerPart) :
+          yield ',\n' + ",\n".join(
+            serialisedTiddlers[start:start + tiddlersPerPart]
+          )
+      yield segment
+
+  def render(
+    self,
+    serialisedTiddlers : list[str],
+    title : Optional[str],
+    storeScriptUrl : str = ""
+  ) -> str :
+    return "".join(
+      self.iterParts(serialisedTiddlers, title, 0, storeScriptUrl)
+    )
+
+  def renderStoreScript(self, serialisedTiddlers : list[str]) -> str :
+    """
+    Return the store script of a split store: a script which, run before
+    TiddlyWiki boots, preloads the scriptBuiltins followed by the provided
+    (already serialised) tiddlers (which so override any builtin of the
+    same title).
+    """
+    return "".join([
+      "(function($tw) {\n",
+      "$tw.preloadTiddlers = ($tw.preloadTiddlers || []).concat([\n",
+      ",\n".join(self.scriptBuiltins + serialisedTiddlers),
+      "\n]);\n",
+      "})(window.$tw = window.$tw || Object.create(null));\n"
+    ])
 
 def extractTiddlersFromHtml(html : str) -> Tiddlers :
   tiddlers : Tiddlers = []
@@ -2,18 +2,26 @@
 Routines for serialising and deserialising tiddlers on disk.
 """
 
-from typing import NoReturn, AsyncGenerator
+from typing import AsyncGenerator, Iterable, Iterator, Optional
 
+import base64
+import binascii
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
+import os
 from pathlib import Path
+import secrets
+import threading
+from urllib.parse import quote
 
 import anyio
 
-from tiddlyServer.types import Tiddler, Tiddlers, TiddlerList
+from tiddlyServer.types import Tiddler, Tiddlers, TiddlerList, FileStat
 from tiddlyServer.tiddlerFilename import titleToFilenameStub
 from tiddlyServer.tiddlerSafety import isTiddlerSafe
-from tiddlyServer.tiddlerEmbedding import embedTiddlersIntoEmptyHtml
+from tiddlyServer.tiddlerEmbedding import EmptyHtmlTemplate
+from tiddlyServer.exceptions import PackCancelled
 
 logger = logging.getLogger('tiddlyWiki')
 
@@ -55,13 +63,18 @@ def deserialiseTid(filename : Path, includeText : bool = True) -> Tiddler :
 
   return tiddler
 
-def serialiseJsonPlusText(tiddler : Tiddler, filename : Path) -> None :
+def serialiseJsonPlusText(
+  tiddler : Tiddler, filename : Path, textFilename : Optional[Path] = None
+) -> None :
   """
   Serialise a tiddler into a .json and .text file. The `.json` filename must
-  be given as the argument.
+  be given as the argument (the `.text` filename defaults to the `.json`
+  filename with a `.text` suffix).
   """
   tiddler = tiddler.copy()
-  with filename.with_suffix(".text").open("w", encoding="utf-8") as f:
+  if textFilename is None :
+    textFilename = filename.with_suffix(".text")
+  with textFilename.open("w", encoding="utf-8") as f:
     f.write(tiddler.pop("text", ""))
   with filename.open("w", encoding="utf-8") as f:
     json.dump(tiddler, f)
@@ -79,90 +92,616 @@ def deserialiseJsonPlusText(filename : Path, includeText : bool = True) :
     tiddler.update(json.load(f))
   return tiddler
 
-def deleteTiddler(directory : Path, title : str) -> list[Path] :
+# The types of the tiddlers whose (base64 encoded) text is binary data
+binaryTypePrefixes = ('image/', 'audio/', 'video/', 'font/')
+binaryTypes = (
+  'application/pdf', 'application/zip', 'application/octet-stream',
+  'application/font-woff', 'application/x-font-ttf'
+)
+textBinaryTypes = ('image/svg+xml',)
+
+def isBinaryTiddler(tiddler : Tiddler) -> bool :
+  """
+  Check whether a tiddler's text is (base64 encoded) binary data.
+  """
+  aType = tiddler.get("type", "")
+  if aType in textBinaryTypes :
+    return False
+  return aType.startswith(binaryTypePrefixes) or aType in binaryTypes
+
+def binaryVersion(aStat : os.stat_result) -> str :
+  # identifies the contents of a .bin file (which are only ever replaced)
+  return f"{aStat.st_mtime_ns:x}-{aStat.st_size:x}"
+
+def binaryUri(directory : Path, binFilename : Path, version : str) -> str :
+  """
+  Return the `_canonical_uri` (relative to the wiki's url) of a binary
+  tiddler's .bin file.
+  """
+  relPath = binFilename.relative_to(directory).as_posix()
+  return f"binary/{quote(relPath, safe='/')}?v={version}"
+
+def fsyncPathsBlocking(paths : Iterable[Path]) -> None :
+  """
+  Flush the given files (or directories) to disk.
+  """
+  for aPath in paths :
+    fd = os.open(aPath, os.O_RDONLY)
+    try :
+      os.fsync(fd)
+    finally :
+      os.close(fd)
+
+def deleteTiddler(
+  directory : Path, title : str, fsync : bool = False
+) -> list[Path] :
   """
   Delete the tiddler file(s) associated with the named tiddler, if it exists.
 
+  If fsync is True, the deletion is flushed to disk before returning.
+
   Returns the full filenames of any deleted files.
   """
   out : list[Path] = []
 
   filenameStub = directory / titleToFilenameStub(title)
-  for suffix in [".tid", ".json", ".text"]:
+  for suffix in [".tid", ".json", ".text", ".meta", ".bin"]:
     filename = filenameStub.with_suffix(suffix)
     if filename.is_file():
       out.append(filename)
       filename.unlink()
 
+  if fsync and out :
+    fsyncPathsBlocking([filenameStub.parent])
   return out
 
-def writeTiddler(directory : Path, tiddler : Tiddler) -> list[Path] :
+def tempFilename(filename : Path) -> Path :
+  # A unique, hidden, name (which is ignored by the readers and watchers
+  # of tiddler files) in the same directory as the filename.
+  return filename.with_name(
+    f".{filename.name}.{secrets.token_hex(6)}.tmp"
+  )
+
+class PreparedTiddler :
+  """
+  A tiddler which has been written to temporary files, ready to be renamed
+  (atomically) over any previous version of the tiddler.
   """
-  Store the given tiddler, replacing any previously existing tiddler file.
 
-  Returns the full filenames of any deleted or created files.
+  tiddler : Tiddler
   """
-  # Delete any previous tiddler (we delete rather than overwriting because
-  # changing the tiddler may change whether it is stored in a single tid file
-  # or in json+text files.
-  title = tiddler.get("title", "")
-  out = deleteTiddler(directory, title)
+  The tiddler as it will be read back from its files (a binary tiddler
+  stored as a .bin file is read back without its text).
+  """
+
+  renames : list[tuple[Path, Path]]
+  """The (temporary, final) name of each file, in the order to rename."""
+
+  staleFiles : list[Path]
+  """The files of the tiddler's other format (if any) to delete."""
+
+  def __init__(
+    self,
+    tiddler : Tiddler,
+    renames : list[tuple[Path, Path]],
+    staleFiles : list[Path]
+  ) -> None :
+    self.tiddler    = tiddler
+    self.renames    = renames
+    self.staleFiles = staleFiles
 
+  def tempFiles(self) -> list[Path] :
+    return [ tempFile for tempFile, _finalFile in self.renames ]
+
+  def discard(self) -> None :
+    for tempFile in self.tempFiles() :
+      tempFile.unlink(missing_ok=True)
+
+def prepareBinaryTiddler(
+  directory : Path, filenameStub : Path, prepared : PreparedTiddler
+) -> bool :
+  """
+  Write a binary tiddler's (base64 decoded) text into a temporary .bin
+  file and its other fields (together with a `_canonical_uri` which serves
+  the .bin file) into a temporary .meta file.
+
+  A tiddler with no text, whose `_canonical_uri` names its existing .bin
+  file (a client saving the tiddler it was given), keeps that .bin file.
+
+  Returns False (having written nothing) if the tiddler can not be stored
+  this way.
+  """
+  tiddler = prepared.tiddler
+  binFilename  = filenameStub.with_suffix(".bin")
+  metaFilename = filenameStub.with_suffix(".meta")
+  fields = tiddler.copy()
+  text = fields.pop("text", None)
+  oldUri = fields.pop("_canonical_uri", None)
+
+  if text :
+    try :
+      data = base64.b64decode(text, validate=True)
+    except (binascii.Error, ValueError) :
+      return False
+    tempBinFile = tempFilename(binFilename)
+    prepared.renames.append((tempBinFile, binFilename))
+    tempBinFile.write_bytes(data)
+    binStat = tempBinFile.stat()
+  elif oldUri and binFilename.is_file() :
+    binStat = binFilename.stat()
+    if oldUri.partition('?')[0] != \
+      binaryUri(directory, binFilename, "").partition('?')[0] :
+      return False
+  else :
+    return False
+
+  fields["_canonical_uri"] = binaryUri(
+    directory, binFilename, binaryVersion(binStat)
+  )
+  # the .bin file is renamed first, since a reader finds the tiddler
+  # through its .meta file
+  tempMetaFile = tempFilename(metaFilename)
+  prepared.renames.append((tempMetaFile, metaFilename))
+  serialiseTid(fields, tempMetaFile)
+  prepared.tiddler = fields
+  prepared.staleFiles = [
+    filenameStub.with_suffix(".tid"),
+    filenameStub.with_suffix(".json"),
+    filenameStub.with_suffix(".text")
+  ]
+  return True
+
+def prepareTiddler(
+  directory : Path,
+  tiddler : Tiddler,
+  fsync : bool = False,
+  externalBinaries : bool = False
+) -> PreparedTiddler :
+  """
+  Write the given tiddler into temporary files next to its final files.
+
+  If externalBinaries is True, a binary tiddler is stored as a raw .bin
+  file (see :py:func:`prepareBinaryTiddler`).
+
+  If fsync is True, the temporary files are flushed to disk before
+  returning.
+  """
+  title = tiddler.get("title", "")
   filenameStub = directory  / titleToFilenameStub(title)
 
   filenameStub.parent.mkdir(parents=True, exist_ok=True)
 
-  if isTiddlerSafe(tiddler):
-    filename = filenameStub.with_suffix(".tid")
-    serialiseTid(tiddler, filename)
-    if filename not in out:
-      out.append(filename)
-  else:
-    jsonFilename = filenameStub.with_suffix(".json")
-    textFilename = filenameStub.with_suffix(".text")
+  prepared = PreparedTiddler(tiddler, [], [])
+  binaryFiles = [
+    filenameStub.with_suffix(".meta"), filenameStub.with_suffix(".bin")
+  ]
+  try :
+    storedAsBinary = externalBinaries and isBinaryTiddler(tiddler) and \
+      isTiddlerSafe(tiddler) and \
+      prepareBinaryTiddler(directory, filenameStub, prepared)
+    if storedAsBinary :
+      # (the .bin and .meta files have been written)
+      pass
+    elif isTiddlerSafe(tiddler):
+      filename = filenameStub.with_suffix(".tid")
+      tempFile = tempFilename(filename)
+      prepared.renames.append((tempFile, filename))
+      serialiseTid(tiddler, tempFile)
+      prepared.staleFiles = [
+        filenameStub.with_suffix(".json"), filenameStub.with_suffix(".text")
+      ] + binaryFiles
+    else:
+      jsonFilename = filenameStub.with_suffix(".json")
+      textFilename = filenameStub.with_suffix(".text")
+      tempJsonFile = tempFilename(jsonFilename)
+      tempTextFile = tempFilename(textFilename)
+      # the .text file is renamed first, since a reader finds the tiddler
+      # through its .json file
+      prepared.renames.append((tempTextFile, textFilename))
+      prepared.renames.append((tempJsonFile, jsonFilename))
+      serialiseJsonPlusText(tiddler, tempJsonFile, tempTextFile)
+      prepared.staleFiles = [ filenameStub.with_suffix(".tid") ] + binaryFiles
+
+    if fsync : fsyncPathsBlocking(prepared.tempFiles())
+  except BaseException :
+    prepared.discard()
+    raise
+  return prepared
+
+def commitTiddler(
+  prepared : PreparedTiddler, fsync : bool = False
+) -> list[Path] :
+  """
+  Rename the prepared tiddler's temporary files over its final files, and
+  delete the files of its other format (if any).
+
+  If fsync is True, the renames are flushed to disk before returning.
 
-    serialiseJsonPlusText(tiddler, jsonFilename)
+  Returns the full filenames of any deleted or created files.
+  """
+  out : list[Path] = []
+  try :
+    for tempFile, finalFile in prepared.renames :
+      tempFile.replace(finalFile)
+      out.append(finalFile)
+  except BaseException :
+    prepared.discard()
+    raise
+  for staleFile in prepared.staleFiles :
+    if staleFile.is_file() :
+      staleFile.unlink()
+      out.append(staleFile)
+
+  if fsync :
+    fsyncPathsBlocking({ aPath.parent for aPath in out })
+  return out
 
-    if jsonFilename not in out:
-      out.append(jsonFilename)
+def prepareTiddlers(
+  directory : Path,
+  tiddlers : Tiddlers,
+  fsync : bool = False,
+  externalBinaries : bool = False
+) -> list[PreparedTiddler] :
+  """
+  Write each of the given tiddlers into temporary files (see
+  :py:func:`prepareTiddler`), flushing them all to disk, if fsync is True,
+  only once they have all been written.
+  """
+  prepared : list[PreparedTiddler] = []
+  try :
+    for aTiddler in tiddlers :
+      prepared.append(
+        prepareTiddler(directory, aTiddler, externalBinaries=externalBinaries)
+      )
+    if fsync :
+      fsyncPathsBlocking(
+        [ aFile for aPrepared in prepared for aFile in aPrepared.tempFiles() ]
+      )
+  except BaseException :
+    for aPrepared in prepared : aPrepared.discard()
+    raise
+  return prepared
+
+def commitTiddlerChanges(
+  directory : Path,
+  changes : list[PreparedTiddler | str],
+  fsync : bool = False
+) -> list[list[Path]] :
+  """
+  In order, commit each prepared tiddler (see :py:func:`commitTiddler`) or
+  delete each (titled) tiddler (see :py:func:`deleteTiddler`).
 
-    if textFilename not in out:
-      out.append(textFilename)
+  If fsync is True, all of the changes are flushed to disk before
+  returning.
 
+  Returns the full filenames of the files deleted or created by each
+  change.
+  """
+  out : list[list[Path]] = []
+  try :
+    for aChange in changes :
+      if isinstance(aChange, PreparedTiddler) :
+        out.append(commitTiddler(aChange))
+      else :
+        out.append(deleteTiddler(directory, aChange))
+  except BaseException :
+    for aChange in changes[len(out):] :
+      if isinstance(aChange, PreparedTiddler) : aChange.discard()
+    raise
+
+  if fsync :
+    fsyncPathsBlocking(
+      { aPath.parent for someFiles in out for aPath in someFiles }
+    )
   return out
 
-def readTiddler(directory : Path, title : str) -> Tiddler | NoReturn :
+def writeTiddler(
+  directory : Path,
+  tiddler : Tiddler,
+  fsync : bool = False,
+  externalBinaries : bool = False
+) -> list[Path] :
   """
-  Read the tiddler with the title given.
+  Store the given tiddler, replacing any previously existing tiddler file.
 
-  Raises a :py:exc:`FileNotFoundError` if the tiddler does not exist.
+  The tiddler is written to temporary files which are then renamed over
+  the previous files, so that a crash (or a concurrent reader) never sees a
+  missing or partly written tiddler. (Changing the tiddler may change
+  whether it is stored in a single tid file or in json+text files, in which
+  case the files of the old format are deleted afterwards.)
+
+  If externalBinaries is True, a binary tiddler is stored as a raw .bin
+  file (plus a .meta file).
+
+  If fsync is True, the new tiddler is flushed to disk before returning.
+
+  Returns the full filenames of any deleted or created files.
   """
-  filenameStub = directory / titleToFilenameStub(title)
+  return commitTiddler(
+    prepareTiddler(directory, tiddler, fsync, externalBinaries), fsync
+  )
+
+class CancelToken :
+  """
+  Allows the event loop to ask a pack (or directory read) running in a
+  worker thread to stop. The worker calls :py:meth:`check` between files
+  (or parts) and so stops soon after :py:meth:`cancel` has been called.
+  """
+
+  def __init__(self) -> None :
+    self.cancelled = threading.Event()
+
+  def cancel(self) -> None :
+    self.cancelled.set()
 
-  tidFilename = filenameStub.with_suffix(".tid")
-  if tidFilename.is_file():
-    return deserialiseTid(tidFilename)
+  def check(self) -> None :
+    """
+    Raise a :py:exc:`PackCancelled` if this token has been cancelled.
+    """
+    if self.cancelled.is_set() :
+      raise PackCancelled()
 
-  jsonFilename = filenameStub.with_suffix(".json")
-  if jsonFilename.is_file():
-    return deserialiseJsonPlusText(jsonFilename)
+def readAllTiddlerFilesBlocking(
+  directory : Path,
+  includeText : bool = True,
+  cancelToken : Optional[CancelToken] = None
+) -> Iterator[tuple[Path, Tiddler]] :
+  """
+  Read all of the tiddlers in the named directory, together with the name
+  of the (.tid or .json) file each was read from.
 
-  raise FileNotFoundError(
-    f"No .tid or .json file could be found for tiddler '{title}'"
+  Raises a :py:exc:`PackCancelled` (between files) if the cancelToken is
+  cancelled.
+  """
+  for tidFilename in directory.glob("**/*.tid"):
+    if cancelToken : cancelToken.check()
+    yield (tidFilename, deserialiseTid(tidFilename, includeText))
+  for jsonFilename in directory.glob("**/*.json"):
+    if cancelToken : cancelToken.check()
+    yield (jsonFilename, deserialiseJsonPlusText(jsonFilename, includeText))
+  for metaFilename in directory.glob("**/*.meta"):
+    if cancelToken : cancelToken.check()
+    yield (metaFilename, deserialiseTid(metaFilename, includeText=False))
+
+def scanTiddlerFilesBlocking(
+  directory : Path, cancelToken : Optional[CancelToken] = None
+) -> list[Path] :
+  """
+  Walk the named directory (once, using os.scandir) listing every .tid,
+  then every .json and then every .meta file (each sorted by path, so that
+  the order does not depend on the order of the directory's entries).
+  """
+  # (the paths are sorted as strings, which is much cheaper than sorting
+  # Path objects)
+  tidFilenames  : list[str] = []
+  jsonFilenames : list[str] = []
+  metaFilenames : list[str] = []
+  dirsToScan = [ str(directory) ]
+  while dirsToScan :
+    if cancelToken : cancelToken.check()
+    with os.scandir(dirsToScan.pop()) as entries :
+      for anEntry in entries :
+        if anEntry.is_dir(follow_symlinks=False) :
+          dirsToScan.append(anEntry.path)
+        elif anEntry.name.endswith(".tid") :
+          tidFilenames.append(anEntry.path)
+        elif anEntry.name.endswith(".json") :
+          jsonFilenames.append(anEntry.path)
+        elif anEntry.name.endswith(".meta") :
+          metaFilenames.append(anEntry.path)
+  return [
+    Path(aFilename)
+    for someFilenames in (tidFilenames, jsonFilenames, metaFilenames)
+    for aFilename in sorted(someFilenames)
+  ]
+
+def decodeText(data : bytes) -> str :
+  # decode as a file opened in (universal newline) text mode would be
+  return data.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+
+def parseTid(content : str, includeText : bool = True) -> Tiddler :
+  """
+  Parse the (already read) contents of a .tid file, exactly as
+  :py:func:`deserialiseTid` reads the file.
+  """
+  tiddler : Tiddler = {}
+  position = 0
+  while position < len(content) :
+    lineEnd = content.find("\n", position)
+    nextPosition = len(content) if lineEnd < 0 else lineEnd + 1
+    field, colon, value = content[position:nextPosition].partition(":")
+    position = nextPosition
+    if colon:
+      tiddler[field.strip()] = value.strip()
+    else:
+      break
+  if includeText :
+    tiddler["text"] = content[position:]
+  return tiddler
+
+def fileStatBlocking(filename : Path) -> Optional[FileStat] :
+  """
+  Return the FileStat of a (.tid, .json or .meta) tiddler file, or None if
+  any of its files are missing.
+  """
+  try :
+    aStat = filename.stat()
+    if filename.suffix != ".json" :
+      return (aStat.st_mtime_ns, aStat.st_size)
+    textStat = filename.with_suffix(".text").stat()
+  except OSError :
+    return None
+  return (
+    aStat.st_mtime_ns, aStat.st_size, textStat.st_mtime_ns, textStat.st_size
+  )
+
+def tiddlerFileStatsBlocking(
+  filenames : Iterable[Path]
+) -> dict[Path, Optional[FileStat]] :
+  """
+  Return the FileStat of the (.tid, .json or .meta) tiddler file of each
+  of the given files (for example those written or deleted by
+  :py:func:`commitTiddlerChanges`), or None if it no longer exists.
+  """
+  fileStats : dict[Path, Optional[FileStat]] = {}
+  for aPath in filenames :
+    aFilename = tiddlerFilename(aPath)
+    if aFilename is None or aFilename in fileStats : continue
+    fileStats[aFilename] = fileStatBlocking(aFilename)
+  return fileStats
+
+readFilesPerBatch = 32
+
+def readAllTiddlerFilesParallelBlocking(
+  directory : Path,
+  includeText : bool = True,
+  cancelToken : Optional[CancelToken] = None,
+  maxWorkers : int = 1,
+  fileStats : Optional[dict[Path, FileStat]] = None
+) -> list[tuple[Path, Tiddler]] :
+  """
+  Read all of the tiddlers in the named directory, together with the name
+  of the (.tid or .json) file each was read from, with the same results as
+  :py:func:`readAllTiddlerFilesBlocking` but in the (deterministic) order
+  of :py:func:`scanTiddlerFilesBlocking`.
+
+  The directory is walked once and then the files are read one at a time
+  or, if maxWorkers is greater than one, by that many threads at the same
+  time (which may hide the latency of each read on slow, for example
+  network, filesystems). The contents are parsed, in order, by the calling
+  thread (parsing holds the GIL and so gains nothing from more threads).
+
+  If a fileStats dictionary is given, the FileStat of each file (as it was
+  when read) is added to it.
+
+  Raises a :py:exc:`PackCancelled` if the cancelToken is cancelled.
+  """
+  filenames = scanTiddlerFilesBlocking(directory, cancelToken)
+
+  def readBytes(filename : str) -> tuple[bytes, FileStat] :
+    with open(filename, "rb") as f :
+      aStat = os.fstat(f.fileno())
+      return (f.read(), (aStat.st_mtime_ns, aStat.st_size))
+
+  def readFile(
+    filename : Path
+  ) -> tuple[bytes, Optional[bytes], FileStat] :
+    if cancelToken : cancelToken.check()
+    data, aStat = readBytes(str(filename))
+    textData = None
+    if includeText and filename.suffix == ".json" :
+      textData, textStat = readBytes(str(filename)[:-5] + ".text")
+      aStat = aStat + textStat
+    return (data, textData, aStat)
+
+  def parseFile(
+    filename : Path,
+    data : bytes,
+    textData : Optional[bytes],
+    aStat : FileStat
+  ) -> Tiddler :
+    if fileStats is not None : fileStats[filename] = aStat
+    if filename.suffix in (".tid", ".meta") :
+      # (a .meta file has no text, its text is in the .bin file)
+      tiddler = parseTid(
+        decodeText(data), includeText and filename.suffix == ".tid"
+      )
+      if 'title' not in tiddler :
+        logger.error(f"No title found in [{filename}]")
+      elif not tiddler['title'] :
+        logger.error(f"Empty title in [{filename}]")
+      return tiddler
+    tiddler = {}
+    if textData is not None :
+      tiddler["text"] = decodeText(textData)
+    tiddler.update(json.loads(data))
+    return tiddler
+
+  if maxWorkers < 2 :
+    return [
+      (aFilename, parseFile(aFilename, *readFile(aFilename)))
+      for aFilename in filenames
+    ]
+
+  # each worker reads a batch of files at a time, which keeps the cost of
+  # handing work to (and results from) the threads small
+  def readFiles(
+    someFilenames : list[Path]
+  ) -> list[tuple[bytes, Optional[bytes], FileStat]] :
+    return [ readFile(aFilename) for aFilename in someFilenames ]
+
+  batches = [
+    filenames[start:start + readFilesPerBatch]
+    for start in range(0, len(filenames), readFilesPerBatch)
+  ]
+  executor = ThreadPoolExecutor(
+    max_workers=maxWorkers, thread_name_prefix="tiddlerReader"
   )
+  try :
+    tiddlers : list[tuple[Path, Tiddler]] = []
+    for someFilenames, someData in zip(
+      batches, executor.map(readFiles, batches)
+    ) :
+      for aFilename, aData in zip(someFilenames, someData) :
+        tiddlers.append((aFilename, parseFile(aFilename, *aData)))
+    return tiddlers
+  finally :
+    # do not read any more files if we have been cancelled (or failed)
+    executor.shutdown(wait=True, cancel_futures=True)
 
 def readAllTiddlersBlocking(
-  directory : Path, extraTiddlers : Tiddlers = [], includeText : bool = True
+  directory : Path,
+  extraTiddlers : Tiddlers = [],
+  includeText : bool = True,
+  cancelToken : Optional[CancelToken] = None
 ) -> Tiddlers :
   """
   Read all of the tiddlers in the named directory.
   """
   for aTid in extraTiddlers :
     yield aTid
-  for tidFilename in directory.glob("**/*.tid"):
-    yield deserialiseTid(tidFilename, includeText)
-  for jsonFilename in directory.glob("**/*.json"):
-    yield deserialiseJsonPlusText(jsonFilename, includeText)
+  for _filename, aTiddler in readAllTiddlerFilesBlocking(
+    directory, includeText, cancelToken
+  ) :
+    yield aTiddler
+
+tiddlerSuffixes = (".tid", ".json", ".text", ".meta", ".bin")
+
+def tiddlerFilename(filename : Path) -> Optional[Path] :
+  """
+  Return the (.tid, .json or .meta) file which names a tiddler, given any
+  of that tiddler's files (or None if the file is not part of a tiddler).
+  """
+  if filename.name.startswith(".") or filename.suffix not in tiddlerSuffixes :
+    return None
+  if filename.suffix == ".text" :
+    return filename.with_suffix(".json")
+  if filename.suffix == ".bin" :
+    return filename.with_suffix(".meta")
+  return filename
+
+def readTiddlerFileBlocking(filename : Path) -> Optional[Tiddler] :
+  """
+  Read the tiddler stored in a .tid, .json (plus .text) or .meta file.
+
+  Returns None if the file does not exist (or could not be read, for
+  example because it is still being written).
+  """
+  if not filename.is_file() :
+    return None
+  try :
+    if filename.suffix == ".tid" :
+      tiddler = deserialiseTid(filename)
+    elif filename.suffix == ".meta" :
+      tiddler = deserialiseTid(filename, includeText=False)
+    else :
+      tiddler = deserialiseJsonPlusText(filename)
+  except (OSError, ValueError) as err :
+    logger.warning(f"Could not (yet) read {filename}: {repr(err)}")
+    return None
+  if 'title' not in tiddler :
+    return None
+  return tiddler
 
 def getExtraTiddlers(wikiUrl : str | None) -> TiddlerList :
   extraTiddlers : TiddlerList = []
@@ -174,26 +713,82 @@ def getExtraTiddlers(wikiUrl : str | None) -> TiddlerList :
     extraTiddlers.append(customPathPrefix)
   return extraTiddlers
 
+emptyHtmlTemplates : dict[
+  tuple[Path, bool], tuple[tuple[int, int], EmptyHtmlTemplate]
+] = {}
+emptyHtmlTemplatesLock = threading.Lock()
+
+def readEmptyHtmlTemplate(
+  emptyHtmlFilename : Path, splitStore : bool = False
+) -> EmptyHtmlTemplate :
+  """
+  Read and parse an empty.html (with, or without, a split store), re-using
+  the previously parsed template unless the file's modification time or
+  size have changed.
+  """
+  fileStat = emptyHtmlFilename.stat()
+  fileKey  = (fileStat.st_mtime_ns, fileStat.st_size)
+  with emptyHtmlTemplatesLock :
+    cached = emptyHtmlTemplates.get((emptyHtmlFilename, splitStore))
+  if cached and cached[0] == fileKey :
+    return cached[1]
+
+  logger.info(f"parsing {emptyHtmlFilename}")
+  template = EmptyHtmlTemplate.fromHtml(
+    emptyHtmlFilename.read_text(), splitStore
+  )
+  with emptyHtmlTemplatesLock :
+    emptyHtmlTemplates[(emptyHtmlFilename, splitStore)] = (fileKey, template)
+  return template
+
+packTiddlersPerCheck = 500
+
 def packTiddlyWikiBlocking(
-  emptyHtmlFilename : Path, tiddlerDir : Path, wikiUrl : str | None
+  emptyHtmlFilename : Path,
+  serialisedTiddlers : list[str],
+  wikiTitle : Optional[str],
+  cancelToken : Optional[CancelToken] = None,
+  storeScriptUrl : Optional[str] = None
 ) -> str :
+  """
+  Pack the given serialised tiddlers (in title order, for example a
+  snapshot of a wiki's :py:class:`TiddlerFragments`) into a copy of the
+  empty.html.
+
+  If a storeScriptUrl is given, the empty.html's store is split (see
+  :py:func:`packStoreScriptBlocking`) and the html loads the store script
+  from that url.
 
-  emptyHtml = emptyHtmlFilename.read_text()
+  Raises a :py:exc:`PackCancelled` (between every packTiddlersPerCheck
+  tiddlers) if the cancelToken is cancelled.
+  """
+
+  template = readEmptyHtmlTemplate(
+    emptyHtmlFilename, storeScriptUrl is not None
+  )
 
-  extraTiddlers = getExtraTiddlers(wikiUrl)
+  if cancelToken is None :
+    return template.render(serialisedTiddlers, wikiTitle, storeScriptUrl or "")
 
-  tiddlers : TiddlerList = []
-  for aTiddler in readAllTiddlersBlocking(
-    tiddlerDir,
-    extraTiddlers=extraTiddlers
+  parts : list[str] = []
+  for aPart in template.iterParts(
+    serialisedTiddlers, wikiTitle, packTiddlersPerCheck, storeScriptUrl or ""
   ) :
-    tiddlers.append(aTiddler)
-  tiddlers = sorted(
-    tiddlers,
-    key=lambda t: t.get("title", ""),
-  )
+    cancelToken.check()
+    parts.append(aPart)
+  cancelToken.check()
+  return "".join(parts)
 
-  return embedTiddlersIntoEmptyHtml(emptyHtml, tiddlers)
+def packStoreScriptBlocking(
+  emptyHtmlFilename : Path, serialisedTiddlers : list[str]
+) -> str :
+  """
+  Pack the given serialised tiddlers (those whose titles start with any of
+  the storeScriptPrefixes) together with the empty.html's own such
+  tiddlers into the store script of a split store.
+  """
+  template = readEmptyHtmlTemplate(emptyHtmlFilename, True)
+  return template.renderStoreScript(serialisedTiddlers)
 
 def unpackTiddlyWiki(
   htmlFilename : Path, tiddlerDir : Path, baseHtmlFilename : Path
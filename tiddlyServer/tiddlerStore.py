@@ -0,0 +1,443 @@
+"""
+An in-memory index of all of the tiddlers of a single wiki.
+"""
+
+from typing import Iterable, Optional
+
+from collections import deque
+import logging
+from pathlib import Path
+import time
+
+from anyio import to_thread, Event
+
+from tiddlyServer.types import Tiddler, Tiddlers, TiddlerList, FileStat
+from tiddlyServer.tiddlerSerDes import readTiddlerFileBlocking, \
+  readAllTiddlerFilesParallelBlocking, scanTiddlerFilesBlocking, \
+  fileStatBlocking, tiddlerFilename, CancelToken
+from tiddlyServer.tiddlerEmbedding import TiddlerFragments, LazyText
+
+logger = logging.getLogger('tiddlyWiki')
+
+def skinnyTiddler(tiddler : Tiddler) -> Tiddler :
+  """
+  Return a copy of the tiddler without its text.
+  """
+  aSkinnyTiddler = tiddler.copy()
+  aSkinnyTiddler.pop('text', None)
+  return aSkinnyTiddler
+
+class TiddlerStore :
+  """
+  Holds every tiddler of one wiki in memory, keyed by title.
+
+  The store is (re)built from the tiddler directory by :py:meth:`rescan`
+  and is then kept current by :py:meth:`applyChanges` (with
+  :py:meth:`recordWrittenFiles` for the files this server writes) or
+  :py:meth:`refreshFiles` (for changes made directly on disk), so that
+  request handlers never need to walk the tiddler directory.
+
+  All methods, other than the ...Blocking methods (which are run in worker
+  threads), MUST be called from the event loop.
+  """
+
+  directory : Path
+
+  tiddlers : dict[str, Tiddler]
+  """All known tiddlers (including their text) keyed by title."""
+
+  fileTitles : dict[Path, str]
+  """
+  The title of the tiddler last read from (or written to) each (.tid or
+  .json) file.
+  """
+
+  titleFiles : dict[str, Path]
+  """The (.tid or .json) file each tiddler was last read from (or written)."""
+
+  fileStats : dict[Path, FileStat]
+  """
+  The FileStat of each (.tid or .json) file when it was last read (or
+  written by this server). (A file changed since then will have a
+  different FileStat.)
+  """
+
+  extraTiddlers : TiddlerList
+  """Tiddlers which are only packed if not overridden by a stored tiddler."""
+
+  fragments : TiddlerFragments
+  """The serialised form of every tiddler (and extra tiddler) to pack."""
+
+  lazyText : Optional[LazyText]
+  """Which tiddlers are packed without their text (if any)."""
+
+  generation : int
+  """
+  A counter which is incremented every time the contents of the store
+  change. The preloader only repacks a wiki when its generation has moved.
+  """
+
+  epoch : str
+  """
+  Identifies this instance of the store so that change tokens issued by an
+  earlier run of the server are never mistaken for our own.
+  """
+
+  changeLog : deque[tuple[int, str]]
+  """The (generation, title) of the most recent changes."""
+
+  changeLogSize : int
+
+  readWorkers : int
+  """The number of files read at the same time when rescanning."""
+
+  forgottenGeneration : int
+  """The newest generation whose changes are no longer in the changeLog."""
+
+  _changeEvent : Optional[Event]
+  """Set (and then forgotten) whenever the store changes."""
+
+  _touchedTitles : Optional[set[str]]
+  """
+  The titles changed while a rescan is in progress (or None if no rescan
+  is in progress).
+  """
+
+  def __init__(
+    self,
+    directory : Path,
+    extraTiddlers : Tiddlers = [],
+    changeLogSize : int = 1000,
+    readWorkers : int = 1,
+    lazyText : Optional[LazyText] = None
+  ) -> None :
+    self.directory      = directory
+    self.tiddlers       = {}
+    self.fileTitles     = {}
+    self.titleFiles     = {}
+    self.fileStats      = {}
+    self.extraTiddlers  = list(extraTiddlers)
+    self.lazyText       = lazyText
+    self.fragments      = TiddlerFragments(self.extraTiddlers, lazyText)
+    self.generation     = 0
+    self.epoch          = f"{time.time_ns():x}"
+    self.changeLog      = deque()
+    self.changeLogSize  = changeLogSize
+    self.readWorkers    = readWorkers
+    self.forgottenGeneration = 0
+    self._changeEvent   = None
+    self._touchedTitles = None
+
+  def _changed(self, titles : Iterable[str]) -> None :
+    # Move to the next generation, recording which titles changed, and
+    # wake anyone waiting for changes.
+    self.generation += 1
+    if self._changeEvent is not None :
+      self._changeEvent.set()
+      self._changeEvent = None
+    titles = list(titles)
+    if self.changeLogSize < len(titles) :
+      self.changeLog.clear()
+      self.forgottenGeneration = self.generation
+      return
+    for aTitle in titles :
+      while self.changeLogSize <= len(self.changeLog) :
+        self.forgottenGeneration = self.changeLog.popleft()[0]
+      self.changeLog.append((self.generation, aTitle))
+
+  def readDirectoryBlocking(
+    self, cancelToken : Optional[CancelToken] = None
+  ) -> tuple[
+    dict[str, Tiddler], dict[Path, str], dict[Path, FileStat],
+    TiddlerFragments
+  ] :
+    """
+    Read (and serialise) all tiddlers from the tiddler directory (in a
+    worker thread).
+    """
+    tiddlers : dict[str, Tiddler] = {}
+    fileTitles : dict[Path, str] = {}
+    fileStats : dict[Path, FileStat] = {}
+    for aFilename, aTiddler in readAllTiddlerFilesParallelBlocking(
+      self.directory,
+      cancelToken=cancelToken,
+      maxWorkers=self.readWorkers,
+      fileStats=fileStats
+    ) :
+      if 'title' in aTiddler :
+        tiddlers[aTiddler['title']] = aTiddler
+        fileTitles[aFilename] = aTiddler['title']
+    fragments = self.fragmentsBlocking(tiddlers)
+    return (tiddlers, fileTitles, fileStats, fragments)
+
+  def fragmentsBlocking(
+    self, tiddlers : dict[str, Tiddler]
+  ) -> TiddlerFragments :
+    """
+    Serialise the given tiddlers (in a worker thread).
+    """
+    fragments = TiddlerFragments(self.extraTiddlers, self.lazyText)
+    fragments.putTiddlers(tiddlers.values())
+    return fragments
+
+  async def rescan(self, cancelToken : Optional[CancelToken] = None) -> None :
+    """
+    Replace the contents of the store with the tiddlers on disk.
+
+    Any tiddlers changed (by applyChanges or refreshFiles) while the
+    directory is being read take precedence over what was read from disk.
+
+    Raises a :py:exc:`PackCancelled`, leaving the store unchanged, if the
+    cancelToken is cancelled while the directory is being read.
+    """
+    self._touchedTitles = set()
+    try :
+      newTiddlers, newFileTitles, newFileStats, newFragments = \
+        await to_thread.run_sync(self.readDirectoryBlocking, cancelToken)
+      self.fileStats = newFileStats
+      for aTitle in self._touchedTitles :
+        if aTitle in self.tiddlers :
+          newTiddlers[aTitle] = self.tiddlers[aTitle]
+          newFragments.putTiddler(self.tiddlers[aTitle])
+        else :
+          newTiddlers.pop(aTitle, None)
+          newFragments.removeTiddler(aTitle)
+    finally :
+      self._touchedTitles = None
+    self._replaceContents(newTiddlers, newFileTitles, newFragments)
+    logger.info(f"indexed {len(self.tiddlers)} tiddlers in {self.directory}")
+
+  def _replaceContents(
+    self,
+    newTiddlers : dict[str, Tiddler],
+    newFileTitles : dict[Path, str],
+    newFragments : TiddlerFragments
+  ) -> None :
+    self.fileTitles = newFileTitles
+    self.titleFiles = {
+      aTitle : aFilename for aFilename, aTitle in newFileTitles.items()
+    }
+    changedTitles = [
+      aTitle for aTitle in self.tiddlers.keys() | newTiddlers.keys()
+      if self.tiddlers.get(aTitle) != newTiddlers.get(aTitle)
+    ]
+    if changedTitles :
+      self.tiddlers  = newTiddlers
+      self.fragments = newFragments
+      self._changed(changedTitles)
+
+  async def restore(
+    self,
+    tiddlers : dict[str, Tiddler],
+    fileTitles : dict[Path, str],
+    fileStats : dict[Path, FileStat]
+  ) -> int :
+    """
+    Replace the contents of the store with a snapshot of a previous store
+    (see :py:mod:`tiddlyServer.snapshot`), and then re-read any tiddler
+    files which have changed since the snapshot was taken.
+
+    Only the tiddlers read from (or written to) the snapshot's files are
+    kept.
+
+    Returns the number of tiddler files which had changed.
+    """
+    tiddlers = {
+      aTitle : tiddlers[aTitle] for aTitle in fileTitles.values()
+      if aTitle in tiddlers
+    }
+    fragments = await to_thread.run_sync(self.fragmentsBlocking, tiddlers)
+    self.fileStats = fileStats
+    self._replaceContents(tiddlers, fileTitles, fragments)
+    changedFiles = await to_thread.run_sync(self.changedFilesBlocking)
+    if changedFiles :
+      await self.refreshFiles(changedFiles)
+    logger.info(
+      f"restored {len(self.tiddlers)} tiddlers in {self.directory} ({len(changedFiles)} files changed)"  # noqa
+    )
+    return len(changedFiles)
+
+  def changedFilesBlocking(
+    self, cancelToken : Optional[CancelToken] = None
+  ) -> set[Path] :
+    """
+    Find the (.tid or .json) files which have been created, changed or
+    deleted since they were last read (in a worker thread), using only
+    the files' FileStats.
+    """
+    changedFiles : set[Path] = set()
+    onDisk = set(scanTiddlerFilesBlocking(self.directory, cancelToken))
+    for aFilename in onDisk :
+      if cancelToken : cancelToken.check()
+      oldStat = self.fileStats.get(aFilename)
+      if oldStat is None or oldStat != fileStatBlocking(aFilename) :
+        changedFiles.add(aFilename)
+    changedFiles.update(self.fileTitles.keys() - onDisk)
+    return changedFiles
+
+  def readFilesBlocking(
+    self, filenames : Iterable[Path]
+  ) -> tuple[list[tuple[Path, Tiddler, Optional[FileStat]]], list[Path]] :
+    """
+    Read the tiddlers in the given (changed) files (in a worker thread),
+    skipping any file whose FileStat shows that it has not changed since it
+    was last read (or written by this server).
+
+    Returns the (filename, tiddler, FileStat) of each tiddler read and the
+    names of any (.tid or .json) files which no longer exist.
+    """
+    updated : list[tuple[Path, Tiddler, Optional[FileStat]]] = []
+    missing : list[Path] = []
+    for aFilename in { tiddlerFilename(aPath) for aPath in filenames } :
+      if aFilename is None : continue
+      aStat = fileStatBlocking(aFilename)
+      if aStat is not None and aStat == self.fileStats.get(aFilename) :
+        continue
+      aTiddler = readTiddlerFileBlocking(aFilename)
+      if aTiddler is not None :
+        updated.append((aFilename, aTiddler, aStat))
+      elif not aFilename.exists() :
+        missing.append(aFilename)
+    return (updated, missing)
+
+  async def refreshFiles(self, filenames : Iterable[Path]) -> int :
+    """
+    Update the store from tiddler files which have been changed on disk
+    (by something other than this server).
+
+    Returns the number of tiddlers which changed.
+    """
+    updated, missing = await to_thread.run_sync(
+      self.readFilesBlocking, filenames
+    )
+    puts : TiddlerList = []
+    removes : list[str] = []
+    for aFilename in missing :
+      self.fileStats.pop(aFilename, None)
+      aTitle = self.fileTitles.pop(aFilename, None)
+      if aTitle is not None and self.titleFiles.get(aTitle) == aFilename :
+        del self.titleFiles[aTitle]
+        removes.append(aTitle)
+    for aFilename, aTiddler, aStat in updated :
+      if aStat is not None : self.fileStats[aFilename] = aStat
+      aTitle = aTiddler['title']
+      oldTitle = self.fileTitles.get(aFilename)
+      if oldTitle is not None and oldTitle != aTitle and \
+        self.titleFiles.get(oldTitle) == aFilename :
+        # the title in this file has been edited
+        del self.titleFiles[oldTitle]
+        removes.append(oldTitle)
+      self.fileTitles[aFilename] = aTitle
+      self.titleFiles[aTitle] = aFilename
+      puts.append(aTiddler)
+    return self.applyChanges(puts, removes)
+
+  def recordWrittenFiles(
+    self, title : str, fileStats : dict[Path, Optional[FileStat]]
+  ) -> None :
+    """
+    Record the (.tid or .json) files of the titled tiddler which this
+    server has just written (with their FileStats) or deleted (None), so
+    that neither the watcher nor a restored snapshot re-reads them.
+    """
+    for aFilename, aStat in fileStats.items() :
+      if aStat is not None :
+        self.fileStats[aFilename]  = aStat
+        self.fileTitles[aFilename] = title
+        self.titleFiles[title]     = aFilename
+        continue
+      self.fileStats.pop(aFilename, None)
+      aTitle = self.fileTitles.pop(aFilename, None)
+      if aTitle is not None and self.titleFiles.get(aTitle) == aFilename :
+        del self.titleFiles[aTitle]
+
+  def _touch(self, title : str) -> None :
+    if self._touchedTitles is not None :
+      self._touchedTitles.add(title)
+
+  def getTiddler(self, title : str) -> Optional[Tiddler] :
+    return self.tiddlers.get(title)
+
+  def applyChanges(self, puts : Tiddlers, removes : Iterable[str]) -> int :
+    """
+    Remove and then put any number of tiddlers as a single change (one new
+    generation) to the store.
+
+    Returns the number of tiddlers which actually changed.
+    """
+    oldTiddlers : dict[str, Optional[Tiddler]] = {}
+    for aTitle in removes :
+      self._touch(aTitle)
+      oldTiddlers.setdefault(aTitle, self.tiddlers.get(aTitle))
+      self.tiddlers.pop(aTitle, None)
+    for aTiddler in puts :
+      aTitle = aTiddler.get('title', '')
+      self._touch(aTitle)
+      oldTiddlers.setdefault(aTitle, self.tiddlers.get(aTitle))
+      self.tiddlers[aTitle] = aTiddler
+
+    changedTitles = [
+      aTitle for aTitle, oldTiddler in oldTiddlers.items()
+      if self.tiddlers.get(aTitle) != oldTiddler
+    ]
+    for aTitle in changedTitles :
+      if aTitle in self.tiddlers :
+        self.fragments.putTiddler(self.tiddlers[aTitle])
+      else :
+        self.fragments.removeTiddler(aTitle)
+    if changedTitles :
+      self._changed(changedTitles)
+    return len(changedTitles)
+
+  def skinnyTiddlers(self) -> TiddlerList :
+    """
+    Return the non-text fields of all tiddlers.
+    """
+    return [ skinnyTiddler(aTiddler) for aTiddler in self.tiddlers.values() ]
+
+  async def waitForChanges(self, generation : int) -> None :
+    """
+    Wait until the store has moved beyond the given generation.
+    """
+    while self.generation <= generation :
+      if self._changeEvent is None :
+        self._changeEvent = Event()
+      await self._changeEvent.wait()
+
+  def changeToken(self) -> str :
+    """
+    Return a token identifying the current contents of the store.
+    """
+    return f"{self.epoch}-{self.generation}"
+
+  def changesSince(
+    self, token : str
+  ) -> Optional[tuple[TiddlerList, list[str]]] :
+    """
+    Return the skinny tiddlers changed and the titles of the tiddlers
+    deleted since the store's changeToken was the given token.
+
+    Returns None if the token is unknown or too old, in which case the
+    caller should fall back to the full list of skinny tiddlers.
+    """
+    epoch, _dash, generationStr = token.rpartition('-')
+    if epoch != self.epoch or not generationStr.isdigit() :
+      return None
+    generation = int(generationStr)
+    if generation < self.forgottenGeneration or self.generation < generation :
+      return None
+
+    changedTitles : set[str] = set()
+    for aGeneration, aTitle in reversed(self.changeLog) :
+      if aGeneration <= generation : break
+      changedTitles.add(aTitle)
+
+    changed : TiddlerList = []
+    deleted : list[str] = []
+    for aTitle in sorted(changedTitles) :
+      aTiddler = self.tiddlers.get(aTitle)
+      if aTiddler is None :
+        deleted.append(aTitle)
+      else :
+        changed.append(skinnyTiddler(aTiddler))
+    return (changed, deleted)
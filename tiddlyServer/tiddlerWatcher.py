@@ -0,0 +1,209 @@
+"""
+Watch a wiki's tiddler directory for files changed by something other than
+this server (an editor, git, rsync...).
+
+On Linux the kernel's inotify interface is used (directly, via ctypes), on
+any other system (or if inotify is not available) the directory is polled.
+"""
+
+from typing import Optional
+
+from abc import ABC, abstractmethod
+import ctypes
+import ctypes.util
+import logging
+import os
+from pathlib import Path
+import select
+import struct
+import sys
+import time
+
+from tiddlyServer.tiddlerSerDes import tiddlerFilename
+
+logger = logging.getLogger('tiddlyWiki')
+
+class DirectoryWatcher(ABC) :
+  """
+  The interface shared by the inotify and polling watchers.
+  """
+
+  directory : Path
+
+  @abstractmethod
+  def readChangesBlocking(self, timeout : float) -> Optional[set[Path]] :
+    """
+    Wait (in a worker thread, for at most timeout seconds) for tiddler
+    files to change. Returns the (possibly empty) set of changed files, or
+    None if the changes are unknown and the whole directory should be
+    rescanned.
+    """
+
+  def close(self) -> None :
+    pass
+
+def isIgnoredDirectory(name : str) -> bool :
+  # ignore hidden directories (in particular .git)
+  return name.startswith(".")
+
+class PollingWatcher(DirectoryWatcher) :
+  """
+  Find changed tiddler files by comparing the modification times and sizes
+  of all files in the tiddler directory.
+  """
+
+  fileStats : dict[Path, tuple[int, int]]
+
+  def __init__(self, directory : Path, pollInterval : float) -> None :
+    self.directory    = directory
+    self.pollInterval = pollInterval
+    self.fileStats    = self.statFilesBlocking()
+
+  def statFilesBlocking(self) -> dict[Path, tuple[int, int]] :
+    fileStats : dict[Path, tuple[int, int]] = {}
+    for dirPath, dirNames, fileNames in os.walk(self.directory) :
+      dirNames[:] = [
+        aName for aName in dirNames if not isIgnoredDirectory(aName)
+      ]
+      for aName in fileNames :
+        aPath = Path(dirPath) / aName
+        if tiddlerFilename(aPath) is None : continue
+        try :
+          aStat = aPath.stat()
+        except OSError :
+          continue
+        fileStats[aPath] = (aStat.st_mtime_ns, aStat.st_size)
+    return fileStats
+
+  def readChangesBlocking(self, timeout : float) -> Optional[set[Path]] :
+    time.sleep(max(timeout, self.pollInterval))
+    oldStats = self.fileStats
+    self.fileStats = self.statFilesBlocking()
+    return {
+      aPath for aPath in oldStats.keys() | self.fileStats.keys()
+      if oldStats.get(aPath) != self.fileStats.get(aPath)
+    }
+
+# see: man 7 inotify
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+
+inotifyMask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+  IN_CREATE | IN_DELETE
+
+inotifyEventHeader = struct.Struct("iIII")
+
+class InotifyWatcher(DirectoryWatcher) :
+  """
+  Find changed tiddler files using the Linux inotify interface, watching
+  every (non-hidden) directory below the tiddler directory.
+  """
+
+  watchedDirs : dict[int, Path]
+  """The directory of each inotify watch descriptor."""
+
+  def __init__(self, directory : Path) -> None :
+    if not sys.platform.startswith("linux") :
+      raise OSError("inotify is only available on Linux")
+    self.directory = directory
+    self.libc = ctypes.CDLL(
+      ctypes.util.find_library("c") or "libc.so.6", use_errno=True
+    )
+    self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self.fd < 0 :
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    self.watchedDirs = {}
+    try :
+      self.watchTreeBlocking(directory)
+    except OSError :
+      self.close()
+      raise
+
+  def watchTreeBlocking(self, directory : Path) -> set[Path] :
+    # Watch the directory (and all of its sub-directories), returning any
+    # tiddler files found in them.
+    found : set[Path] = set()
+    for dirPath, dirNames, fileNames in os.walk(directory) :
+      dirNames[:] = [
+        aName for aName in dirNames if not isIgnoredDirectory(aName)
+      ]
+      wd = self.libc.inotify_add_watch(
+        self.fd, os.fsencode(dirPath), inotifyMask
+      )
+      if wd < 0 :
+        raise OSError(ctypes.get_errno(), f"could not watch {dirPath}")
+      self.watchedDirs[wd] = Path(dirPath)
+      for aName in fileNames :
+        found.add(Path(dirPath) / aName)
+    return found
+
+  def readChangesBlocking(self, timeout : float) -> Optional[set[Path]] :
+    ready, _writable, _errors = select.select([self.fd], [], [], timeout)
+    if not ready : return set()
+
+    changes : set[Path] = set()
+    while True :
+      try :
+        data = os.read(self.fd, 64 * 1024)
+      except BlockingIOError :
+        break
+      offset = 0
+      while offset < len(data) :
+        wd, mask, _cookie, length = inotifyEventHeader.unpack_from(
+          data, offset
+        )
+        offset += inotifyEventHeader.size
+        name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+        offset += length
+
+        if mask & IN_Q_OVERFLOW :
+          # we have lost some events... so rescan everything
+          return None
+        if mask & IN_IGNORED :
+          self.watchedDirs.pop(wd, None)
+          continue
+        dirPath = self.watchedDirs.get(wd)
+        if dirPath is None or not name : continue
+        aPath = dirPath / name
+        if mask & IN_ISDIR :
+          if isIgnoredDirectory(name) : continue
+          if mask & (IN_CREATE | IN_MOVED_TO) :
+            try :
+              changes.update(self.watchTreeBlocking(aPath))
+            except OSError :
+              return None
+          elif mask & IN_MOVED_FROM :
+            # we do not know which tiddlers have just left
+            return None
+          continue
+        changes.add(aPath)
+    return {
+      aPath for aPath in changes if tiddlerFilename(aPath) is not None
+    }
+
+  def close(self) -> None :
+    if 0 <= self.fd :
+      os.close(self.fd)
+      self.fd = -1
+
+def createDirectoryWatcherBlocking(
+  directory : Path, pollInterval : float
+) -> DirectoryWatcher :
+  """
+  Create an inotify watcher for the directory, falling back to polling the
+  directory if inotify is not available.
+  """
+  try :
+    watcher : DirectoryWatcher = InotifyWatcher(directory)
+    logger.info(f"watching {directory} using inotify")
+  except (OSError, AttributeError) as err :
+    logger.info(f"inotify not available ({repr(err)})")
+    watcher = PollingWatcher(directory, pollInterval)
+    logger.info(f"watching {directory} every {pollInterval} seconds")
+  return watcher
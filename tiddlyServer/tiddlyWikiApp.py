@@ -3,21 +3,31 @@ A Starlette based webserver implementing (a bare-bones subset of) the
 TiddlyWeb API.
 """
 
-from typing import Any
+from typing import Any, AsyncIterator, Optional
 
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+import json
 import logging
 import os
 from pathlib import Path
 
+from anyio import to_thread, move_on_after, CancelScope
+
 from starlette.applications import Starlette
-from starlette.responses import Response, HTMLResponse, JSONResponse
+from starlette.responses import Response, HTMLResponse, JSONResponse, \
+  StreamingResponse, FileResponse
 from starlette.requests import Request
 from starlette.routing import Route
 
-from tiddlyServer.types import Tiddler, WikiDef
-from tiddlyServer.tiddlerSerDes import readTiddler, readAllTiddlersBlocking, \
-  writeTiddler, deleteTiddler
-from tiddlyServer.preLoader import reloadTiddlyWiki
+from tiddlyServer.types import Tiddler, WikiDef, FileStat
+from tiddlyServer.tiddlerSerDes import PreparedTiddler, prepareTiddlers, \
+  commitTiddlerChanges, getExtraTiddlers, readEmptyHtmlTemplate, \
+  deserialiseTid, binaryVersion, tiddlerFileStatsBlocking
+from tiddlyServer.tiddlerStore import TiddlerStore
+from tiddlyServer.tiddlerEmbedding import LazyText
+from tiddlyServer.preLoader import reloadTiddlyWiki, waitForTiddlyWiki, \
+  wikiIsFresh, PackedStoreScript
 
 from tiddlyServer.tiddlerHash import tiddlerHash
 
@@ -30,7 +40,7 @@ appRoutes : list[Route] = []
 async def corsOptions(request : Request) -> Response :
   return Response(
     "", headers={
-      'Allow' : 'OPTIONS,GET,HEAD,PUT,DELETE'
+      'Allow' : 'OPTIONS,GET,HEAD,PUT,POST,DELETE'
     }
   )
 
@@ -38,7 +48,208 @@ appRoutes.append(Route(
   '/', endpoint=corsOptions, methods=['OPTIONS']
 ))
 
-async def getIndex(request : Request) -> HTMLResponse :
+async def runStorageIo(request : Request, func, *args) -> Any :
+  # Run blocking tiddler storage I/O (open, unlink, mkdir, ...) in a
+  # worker thread, so that a slow disk never stalls the event loop. At most
+  # ioWorkers such threads run at once (across all wikis).
+  return await to_thread.run_sync(
+    func, *args, limiter=request.app.state.ioLimiter
+  )
+
+async def storeTiddlerChanges(
+  request : Request, changes : list[Tiddler | str]
+) -> list[list[Path]] :
+  # In order, write each tiddler (or delete each titled tiddler) on disk
+  # (as the wiki's durability asks) and then record the result in the
+  # tiddlerStore as a single change. Returns the files written or deleted
+  # by each change.
+  #
+  # The tiddlers are written to temporary files (concurrently with other
+  # writes) which the writeLock then renames in order, so that this wiki's
+  # files and tiddlerStore always agree. Once started, a write is always
+  # finished even if the client goes away.
+  state = request.app.state
+  fsync = state.durability == 'fsync'
+  tiddlers = [ aChange for aChange in changes if isinstance(aChange, dict) ]
+  with CancelScope(shield=True) :
+    prepared = await runStorageIo(
+      request, prepareTiddlers, state.tiddlerDir, tiddlers, fsync,
+      state.binaryTiddlers == 'external'
+    )
+    if state.durability == 'group' and prepared :
+      try :
+        await state.groupCommitter.fsync([
+          aFile for aPrepared in prepared for aFile in aPrepared.tempFiles()
+        ])
+      except OSError :
+        for aPrepared in prepared :
+          await runStorageIo(request, aPrepared.discard)
+        raise
+
+    nextPrepared = iter(prepared)
+    commits : list[PreparedTiddler | str] = [
+      aChange if isinstance(aChange, str) else next(nextPrepared)
+      for aChange in changes
+    ]
+    async with state.writeLock :
+      changedFiles = await runStorageIo(
+        request, commitTiddlerChanges, state.tiddlerDir, commits, fsync
+      )
+
+      def changedStatsBlocking() -> list[dict[Path, Optional[FileStat]]] :
+        return [
+          tiddlerFileStatsBlocking(someFiles) for someFiles in changedFiles
+        ]
+
+      changedStats = await runStorageIo(request, changedStatsBlocking)
+      # the last change to each title wins (and a tiddler is stored as it
+      # will be read back from its files)
+      finalTiddlers : dict[str, Optional[Tiddler]] = {}
+      for aCommit, someFiles, someStats in zip(
+        commits, changedFiles, changedStats
+      ) :
+        if not someFiles : continue
+        if isinstance(aCommit, str) :
+          aTitle = aCommit
+          finalTiddlers[aTitle] = None
+        else :
+          aTitle = aCommit.tiddler.get('title', '')
+          finalTiddlers[aTitle] = aCommit.tiddler
+        # (so that the watcher does not re-read the files we have written)
+        state.tiddlerStore.recordWrittenFiles(aTitle, someStats)
+      state.tiddlerStore.applyChanges(
+        [ aTiddler for aTiddler in finalTiddlers.values() if aTiddler ],
+        [
+          aTitle for aTitle, aTiddler in finalTiddlers.items()
+          if aTiddler is None
+        ]
+      )
+
+    if state.durability == 'group' :
+      changedDirs = {
+        aPath.parent for someFiles in changedFiles for aPath in someFiles
+      }
+      if changedDirs : await state.groupCommitter.fsync(changedDirs)
+  return changedFiles
+
+def tiddlerFromTiddlyWeb(tiddlerDict : dict[str, Any]) -> Tiddler :
+  # Convert a tiddler, in the JSON format sent by TiddlyWiki's TiddlyWeb
+  # syncer, into the tiddler we store (with a revision which is the hash of
+  # its contents).
+
+  # Undo silly TiddlyWeb formatting
+  tiddlerFields : dict[str, Any] = tiddlerDict.get('fields', {})
+  tiddler : Tiddler = {}
+  for aKey, aValue in tiddlerDict.items() :
+    if isinstance(aValue, str) :
+      tiddler[aKey] = aValue
+  if isinstance(tiddlerFields, dict) :
+    for aKey, aValue in tiddlerFields.items() :
+      if isinstance(aValue, str) :
+        tiddler[aKey] = aValue
+
+  if isinstance(tiddlerDict.get("tags"), list) :
+    tiddler["tags"] = " ".join(
+      f"[[{tag}]]" for tag in tiddlerDict["tags"]
+    )
+
+  # Mandatory for TiddlyWeb but (but unused by this implementation)
+  tiddler["bag"] = "bag"
+
+  # Set revision to hash of Tiddler contents
+  tiddler.pop("revision", None)
+  tiddler["revision"] = tiddlerHash(tiddler)
+
+  return tiddler
+
+def unskinnyTiddler(
+  tiddlerStore : TiddlerStore, tiddler : Tiddler
+) -> Tiddler :
+  # A skinny tiddler (one packed without its text, see lazyTextSize) which
+  # is saved before its text has been loaded keeps its stored text.
+  if '_is_skinny' not in tiddler : return tiddler
+  tiddler = tiddler.copy()
+  del tiddler['_is_skinny']
+  storedTiddler = tiddlerStore.getTiddler(tiddler.get('title', ''))
+  if 'text' not in tiddler and storedTiddler and 'text' in storedTiddler :
+    tiddler['text'] = storedTiddler['text']
+  tiddler.pop("revision", None)
+  tiddler["revision"] = tiddlerHash(tiddler)
+  return tiddler
+
+def tiddlerEtag(tiddler : Tiddler) -> str :
+  title = tiddler.get("title", "")
+  revision = tiddler.get("revision", "")
+  return f'"bag/{title}/{revision}:{revision}"'
+
+async def loadedTiddlerStore(request : Request) -> TiddlerStore :
+  # Return this wiki's in-memory tiddlerStore once it has been built.
+
+  if not request.app.state.storeLoaded.is_set() :
+    # a lazy wiki's tiddlerStore is built when it is first used
+    request.app.state.wikiNeedsLoading.set()
+  await request.app.state.storeLoaded.wait()
+  return request.app.state.tiddlerStore
+
+def acceptsGzip(request : Request) -> bool :
+  # Does the client's Accept-Encoding header allow a gzip encoded response?
+  # An explicit `gzip` entry (even `gzip;q=0`) overrides any `*` entry.
+  qualities : dict[str, float] = {}
+  for anEncoding in request.headers.get('accept-encoding', '').split(',') :
+    coding, _semicolon, params = anEncoding.partition(';')
+    coding = coding.strip().lower()
+    if coding not in ('gzip', '*') : continue
+    quality = params.strip().lower().removeprefix('q=')
+    try :
+      qualities[coding] = float(quality) if params.strip() else 1.0
+    except ValueError :
+      qualities[coding] = 0.0
+  return 0 < qualities.get('gzip', qualities.get('*', 0.0))
+
+def isNotModified(
+  request : Request, etag : str, lastModified : Optional[datetime] = None
+) -> bool :
+  # Does the client's If-None-Match (or, if there is none, its
+  # If-Modified-Since) header show that it already has this response?
+  ifNoneMatch = request.headers.get('if-none-match')
+  if ifNoneMatch is not None :
+    for aTag in ifNoneMatch.split(',') :
+      aTag = aTag.strip().removeprefix('W/')
+      if aTag == etag or aTag == '*' : return True
+    return False
+  ifModifiedSince = request.headers.get('if-modified-since')
+  if ifModifiedSince is not None and lastModified is not None :
+    try :
+      return lastModified <= parsedate_to_datetime(ifModifiedSince)
+    except (TypeError, ValueError) :
+      return False
+  return False
+
+# The number of tiddlers sent in each chunk of a streamed index
+streamTiddlersPerChunk = 256
+
+async def streamIndex(request : Request) -> StreamingResponse :
+  # Stream a copy of the empty.html with all tiddlers in the tiddlerStore
+  # embedded, starting with the empty.html's prefix, WITHOUT waiting for the
+  # preloader to pack the whole wiki.
+
+  tiddlerStore = await loadedTiddlerStore(request)
+  template = await to_thread.run_sync(
+    readEmptyHtmlTemplate, request.app.state.emptyHtmlFilename
+  )
+  serialisedTiddlers = tiddlerStore.fragments.orderedFragments()
+  wikiTitle = tiddlerStore.fragments.wikiTitle()
+
+  async def htmlChunks() -> AsyncIterator[bytes] :
+    for aPart in template.iterParts(
+      serialisedTiddlers, wikiTitle, streamTiddlersPerChunk
+    ) :
+      yield aPart.encode('utf-8')
+
+  logger.info(f"Streaming {request.app.state.name} HTML")
+  return StreamingResponse(htmlChunks(), media_type="text/html")
+
+async def getIndex(request : Request) -> Response :
   # Return a copy of the empty.html with all tiddlers in the tiddler directory
   # pre-loaded.
 
@@ -51,21 +262,92 @@ async def getIndex(request : Request) -> HTMLResponse :
   #   str(request.app.state.wikiUrl)
   # )
 
+  if request.app.state.streamIndex :
+    return await streamIndex(request)
+
   logger.info(f"Looking for {request.app.state.name} HTML")
-  html = None
-  while True :
-    async with request.app.state.htmlLock :
-      if not request.app.state.wikiNeedsLoading.is_set() :
-        html = request.app.state.html
-        if html : break
+  if not await waitForTiddlyWiki(request.app) :
+    logger.warning(f"Timed out waiting for {request.app.state.name} HTML")
+    return HTMLResponse(
+      f"{request.app.state.name} is still loading, please try again",
+      status_code=503,
+      headers={'Retry-After' : '5'}
+    )
 
-  logger.info(f"Found {request.app.state.name} HTML")
-  return HTMLResponse(html)
+  packed = request.app.state.packed
+  gzipped = packed.htmlGzip is not None and acceptsGzip(request)
+  headers = {
+    'Vary'          : 'Accept-Encoding',
+    'Cache-Control' : 'no-cache',
+    'ETag'          : packed.etag(gzipped),
+    'Last-Modified' : formatdate(packed.lastModified.timestamp(), usegmt=True)
+  }
+  if not wikiIsFresh(request.app) :
+    # serving the last good html while the wiki is being repacked
+    headers['X-TiddlyServer-Stale'] = 'true'
+    logger.info(f"Found stale {request.app.state.name} HTML")
+  else :
+    logger.info(f"Found {request.app.state.name} HTML")
+  if isNotModified(request, headers['ETag'], packed.lastModified) :
+    return Response(status_code=304, headers=headers)
+  if gzipped :
+    headers['Content-Encoding'] = 'gzip'
+    return HTMLResponse(packed.htmlGzip, headers=headers)
+  return HTMLResponse(packed.html, headers=headers)
 
 appRoutes.append(Route(
   '/', endpoint=getIndex, methods=['GET']
 ))
 
+def findStoreScript(
+  request : Request, contentHash : str
+) -> Optional[PackedStoreScript] :
+  # (the previous store script is kept for any page served before the
+  # current one was packed)
+  for aScript in [
+    request.app.state.storeScript, request.app.state.previousStoreScript
+  ] :
+    if aScript is not None and aScript.contentHash == contentHash :
+      return aScript
+  return None
+
+async def getStoreScript(request : Request) -> Response :
+  # Serve the store script (the plugin and core tiddlers) of a wiki with a
+  # split store. As the script is named by its contentHash, it may be
+  # cached for ever.
+
+  contentHash = request.path_params['contentHash']
+  storeScript = findStoreScript(request, contentHash)
+  if storeScript is None and request.app.state.splitStore and \
+    not request.app.state.streamIndex and request.app.state.packed is None :
+    # (the wiki's packed html, and its store script, have been evicted)
+    await waitForTiddlyWiki(request.app)
+    storeScript = findStoreScript(request, contentHash)
+  if storeScript is None :
+    return Response("", status_code=404)
+
+  gzipped = storeScript.scriptGzip is not None and acceptsGzip(request)
+  headers = {
+    'Vary'          : 'Accept-Encoding',
+    'Cache-Control' : 'public, max-age=31536000, immutable',
+    'ETag'          : storeScript.etag(gzipped)
+  }
+  if isNotModified(request, headers['ETag']) :
+    return Response(status_code=304, headers=headers)
+  if gzipped :
+    headers['Content-Encoding'] = 'gzip'
+    return Response(
+      storeScript.scriptGzip, headers=headers,
+      media_type='application/javascript'
+    )
+  return Response(
+    storeScript.script, headers=headers, media_type='application/javascript'
+  )
+
+appRoutes.append(Route(
+  '/store-{contentHash}.js', endpoint=getStoreScript, methods=['GET']
+))
+
 async def getStatus(request : Request) -> JSONResponse :
   # Bare-minimum response which minimises UI cruft like usernames and login
   # screens.
@@ -81,30 +363,170 @@ appRoutes.append(Route(
   '/status', endpoint=getStatus, methods=['GET']
 ))
 
+async def getBuildStatus(request : Request) -> JSONResponse :
+  # Report on the preloader's builds of this wiki (for monitoring), unlike
+  # /status which is the TiddlyWeb status expected by TiddlyWiki.
+  state = request.app.state
+  return JSONResponse({
+    "name": state.name,
+    "generation": state.tiddlerStore.generation,
+    "packedGeneration": state.packedGeneration,
+    "fresh": wikiIsFresh(request.app),
+    "completedBuilds": state.completedBuilds,
+    "cancelledBuilds": state.cancelledBuilds,
+    "packedBytes": state.packed.numBytes if state.packed else 0,
+    "evictions": state.evictions,
+  })
+
+appRoutes.append(Route(
+  '/buildStatus', endpoint=getBuildStatus, methods=['GET']
+))
+
 async def getReloadTiddlyWiki(request : Request ) -> Response :
-  reloadTiddlyWiki(request.app)
+  # The tiddlers on disk have been changed by some external tool.
+  reloadTiddlyWiki(request.app, rescanDisk=True)
   return Response("done")
 
 appRoutes.append(Route(
   '/reload', endpoint=getReloadTiddlyWiki, methods=['GET']
 ))
 
-async def getSkinnyTiddlers(request : Request) -> JSONResponse :
+async def getSkinnyTiddlers(request : Request) -> Response :
   # Return the JSON-ified non-text fields of all local tiddler files.
   #
   # NB: We don't emulate the slightly quirky TiddlyWeb JSON format here since
   # the TiddlyWiki implementation will cope just fine with a plain JSON object
   # describing a tiddler's fields.
-
-  tiddlerDir = request.app.state.tiddlerDir
-  skinnyTiddlers = list(readAllTiddlersBlocking(tiddlerDir, includeText=False))
-  reloadTiddlyWiki(request.app)
-  return JSONResponse(skinnyTiddlers)
+  #
+  # If a `since` change token (from the X-TiddlyServer-Token header or from
+  # a previous `since` response) is given, ONLY the tiddlers changed or
+  # deleted since then are returned as:
+  #   {"token": ..., "full": false, "changed": [...], "deleted": [...]}
+  # If the token is too old (or unknown) "full" is true and "changed"
+  # lists all tiddlers. If `wait=<seconds>` is also given, the response is
+  # delayed until something changes (a long-poll).
+
+  tiddlerStore = await loadedTiddlerStore(request)
+
+  # Long-poll: with both `since` and `wait=<seconds>`, wait (for at most
+  # longPollMaxWait seconds) until there is some change to report.
+  since = request.query_params.get('since')
+  waitFor = request.query_params.get('wait', '0')
+  if since is not None and since == tiddlerStore.changeToken() :
+    try :
+      waitSeconds = min(float(waitFor), longPollMaxWait)
+    except ValueError :
+      waitSeconds = 0
+    if 0 < waitSeconds :
+      with move_on_after(waitSeconds) :
+        await tiddlerStore.waitForChanges(tiddlerStore.generation)
+
+  token = tiddlerStore.changeToken()
+  headers = {
+    'ETag'                 : f'"skinny-{token}"',
+    'Cache-Control'        : 'no-cache',
+    'X-TiddlyServer-Token' : token
+  }
+
+  if since is not None :
+    changes = tiddlerStore.changesSince(since)
+    if changes is None :
+      return JSONResponse({
+        'token'   : token,
+        'full'    : True,
+        'changed' : tiddlerStore.skinnyTiddlers(),
+        'deleted' : []
+      }, headers=headers)
+    changed, deleted = changes
+    return JSONResponse({
+      'token'   : token,
+      'full'    : False,
+      'changed' : changed,
+      'deleted' : deleted
+    }, headers=headers)
+
+  if isNotModified(request, headers['ETag']) :
+    return Response(status_code=304, headers=headers)
+  return JSONResponse(tiddlerStore.skinnyTiddlers(), headers=headers)
 
 appRoutes.append(Route(
   '/recipes/all/tiddlers.json', endpoint=getSkinnyTiddlers, methods=['GET']
 ))
 
+# The longest time a long-poll of the skinny tiddlers may wait
+longPollMaxWait = 60
+
+# How often a comment is sent to keep idle event streams open
+sseKeepAliveSeconds = 15
+
+def sseEvent(
+  eventType : str, data : dict[str, Any], eventId : Optional[str] = None
+) -> bytes :
+  # Format one Server-Sent Event.
+  lines = [f"event: {eventType}", f"data: {json.dumps(data)}"]
+  if eventId is not None :
+    lines.append(f"id: {eventId}")
+  return ("\n".join(lines) + "\n\n").encode('utf-8')
+
+async def getEvents(request : Request) -> StreamingResponse :
+  # A stream of Server-Sent Events describing every change made to this
+  # wiki's tiddlers (whether by the TiddlyWeb API or on disk):
+  #
+  #   event: change
+  #   data: {"title": ..., "revision": ..., "deleted": false}
+  #   id: <change token>
+  #
+  # A reconnecting client's Last-Event-ID (or a `since` query parameter)
+  # is used to replay any changes it missed. If those changes are no
+  # longer known, a "reset" event asks the client to fetch the full list
+  # of skinny tiddlers.
+
+  tiddlerStore = await loadedTiddlerStore(request)
+  token = request.headers.get('last-event-id') or \
+    request.query_params.get('since') or \
+    tiddlerStore.changeToken()
+
+  async def events() -> AsyncIterator[bytes] :
+    nonlocal token
+    yield b"retry: 5000\n\n"
+    while True :
+      generation = tiddlerStore.generation
+      newToken = tiddlerStore.changeToken()
+      if newToken != token :
+        changes = tiddlerStore.changesSince(token)
+        if changes is None :
+          yield sseEvent('reset', {'token' : newToken}, newToken)
+        else :
+          changed, deleted = changes
+          messages = [
+            {
+              'title'    : aTiddler.get('title', ''),
+              'revision' : aTiddler.get('revision', ''),
+              'deleted'  : False
+            } for aTiddler in changed
+          ] + [
+            { 'title' : aTitle, 'deleted' : True } for aTitle in deleted
+          ]
+          for index, aMessage in enumerate(messages) :
+            # only the last event of a batch carries the new token
+            lastOne = index == len(messages) - 1
+            yield sseEvent('change', aMessage, newToken if lastOne else None)
+        token = newToken
+      with move_on_after(sseKeepAliveSeconds) as keepAlive :
+        await tiddlerStore.waitForChanges(generation)
+      if keepAlive.cancelled_caught :
+        yield b": keepalive\n\n"
+
+  return StreamingResponse(
+    events(),
+    media_type="text/event-stream",
+    headers={'Cache-Control' : 'no-cache', 'X-Accel-Buffering' : 'no'}
+  )
+
+appRoutes.append(Route(
+  '/events', endpoint=getEvents, methods=['GET']
+))
+
 async def getTiddler(request : Request) -> Response :
   # Read a tiddler.
   #
@@ -116,56 +538,79 @@ async def getTiddler(request : Request) -> Response :
 
   title = request.path_params['title']
 
-  tiddlerDir = request.app.state.tiddlerDir
+  tiddlerStore = await loadedTiddlerStore(request)
 
-  try:
-    return JSONResponse(readTiddler(tiddlerDir, title))
-  except FileNotFoundError:
+  tiddler = tiddlerStore.getTiddler(title)
+  if tiddler is None :
     return Response("", status_code=404)
+  return JSONResponse(tiddler)
 
 appRoutes.append(Route(
   '/recipes/all/tiddlers/{title:path}', endpoint=getTiddler, methods=['GET']
 ))
 
-async def putTiddler(request : Request) -> Response:
-  # Store (or modify) a tiddler.
-
-  title = request.path_params['title']
+async def getBinary(request : Request) -> Response :
+  # Serve the raw .bin file of a binary tiddler (stored with
+  # `binaryTiddlers: external`) named by the tiddler's `_canonical_uri`.
+  #
+  # The `_canonical_uri` includes the version of the .bin file it names,
+  # so (while that is still the file's version) the file may be cached for
+  # ever.
 
   tiddlerDir = request.app.state.tiddlerDir
+  binFilename = tiddlerDir / request.path_params['path']
+  if binFilename.suffix != ".bin" or binFilename.name.startswith(".") :
+    return Response("", status_code=404)
 
-  tiddlerDict : dict[str, Any] = await request.json()
+  def binaryFileBlocking() -> Optional[tuple[os.stat_result, str]] :
+    # only the .bin files of (inside the tiddlerDir) tiddlers are served
+    realFilename = Path(os.path.realpath(binFilename))
+    if not realFilename.is_relative_to(tiddlerDir) : return None
+    metaFilename = binFilename.with_suffix(".meta")
+    if not metaFilename.is_file() or not binFilename.is_file() :
+      return None
+    fields = deserialiseTid(metaFilename, includeText=False)
+    return (binFilename.stat(), fields.get('type', ''))
+
+  found = await runStorageIo(request, binaryFileBlocking)
+  if found is None :
+    return Response("", status_code=404)
+  binStat, mediaType = found
+
+  etag = f'"{binaryVersion(binStat)}"'
+  headers = { 'ETag' : etag, 'Cache-Control' : 'no-cache' }
+  if request.query_params.get('v') == binaryVersion(binStat) :
+    headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+  if isNotModified(request, etag) :
+    return Response(status_code=304, headers=headers)
+  return FileResponse(
+    binFilename,
+    stat_result=binStat,
+    headers=headers,
+    media_type=mediaType or 'application/octet-stream'
+  )
 
-  # Undo silly TiddlyWeb formatting
-  tiddlerFields : dict[str, Any] = tiddlerDict.pop('fields', {})
-  tiddler : Tiddler = {}
-  for aKey, aValue in tiddlerDict.items() :
-    if isinstance(aValue, str) :
-      tiddler[aKey] = aValue
-  for aKey, aValue in tiddlerFields.items() :
-    if isinstance(aValue, str) :
-      tiddler[aKey] = aValue
+appRoutes.append(Route(
+  '/binary/{path:path}', endpoint=getBinary, methods=['GET']
+))
 
-  if "tags" in tiddlerDict:
-    tiddler["tags"] = " ".join(
-      f"[[{tag}]]" for tag in tiddlerDict.get("tags", [])
-    )
+async def putTiddler(request : Request) -> Response:
+  # Store (or modify) a tiddler.
 
-  # Mandatory for TiddlyWeb but (but unused by this implementation)
-  tiddler["bag"] = "bag"
+  title = request.path_params['title']
 
-  # Set revision to hash of Tiddler contents
-  tiddler.pop("revision", None)
-  hash = tiddlerHash(tiddler)
-  tiddler["revision"] = revision = hash
+  tiddlerDict : dict[str, Any] = await request.json()
+
+  tiddler = tiddlerFromTiddlyWeb(tiddlerDict)
 
   # Sanity check
   assert title == tiddler.get("title")
 
-  filesWritten = writeTiddler(tiddlerDir, tiddler)
+  tiddler = unskinnyTiddler(await loadedTiddlerStore(request), tiddler)
 
-  etag = f'"bag/{title}/{revision}:{hash}"'
-  headers = {"Etag": etag}
+  filesWritten, = await storeTiddlerChanges(request, [tiddler])
+
+  headers = {"Etag": tiddlerEtag(tiddler)}
 
   if filesWritten :
     reloadTiddlyWiki(request.app)
@@ -185,9 +630,10 @@ async def removeTiddler(request : Request) -> Response :
   # Delete a tiddler.
 
   title = request.path_params['title']
-  tiddlerDir = request.app.state.tiddlerDir
 
-  deletedFiles = deleteTiddler(tiddlerDir, title)
+  await loadedTiddlerStore(request)
+
+  deletedFiles, = await storeTiddlerChanges(request, [title])
 
   if deletedFiles :
     reloadTiddlyWiki(request.app)
@@ -199,6 +645,77 @@ appRoutes.append(Route(
   '/bags/bag/tiddlers/{title:path}', endpoint=removeTiddler, methods=["DELETE"]
 ))
 
+async def postBulkTiddlers(request : Request) -> Response :
+  # Store (or modify) and delete any number of tiddlers with a single
+  # update of the tiddlerStore (and so a single rebuild of the wiki).
+  #
+  # The body is a JSON array, each item of which is either a tiddler (in
+  # the same TiddlyWeb format as a PUT) or `{"op": "delete", "title": ...}`.
+  # The changes are made in order. If any item is not valid nothing is
+  # changed.
+  #
+  # The response is a JSON array with the title, (HTTP) status and (for
+  # stored tiddlers) ETag of each item.
+
+  try :
+    items = await request.json()
+  except ValueError :
+    return Response("ERROR: the body MUST be JSON", status_code=400)
+  if not isinstance(items, list) :
+    return Response("ERROR: the body MUST be a JSON array", status_code=400)
+
+  changes : list[Tiddler | str] = []
+  for itemNum, anItem in enumerate(items) :
+    if not isinstance(anItem, dict) :
+      return Response(
+        f"ERROR: item {itemNum} MUST be a JSON object", status_code=400
+      )
+    if anItem.get('op') == 'delete' :
+      title = anItem.get('title')
+      if not isinstance(title, str) or not title :
+        return Response(
+          f"ERROR: item {itemNum} MUST have a title to delete",
+          status_code=400
+        )
+      changes.append(title)
+    else :
+      tiddler = tiddlerFromTiddlyWeb(anItem)
+      if not tiddler.get('title') :
+        return Response(
+          f"ERROR: item {itemNum} MUST have a title", status_code=400
+        )
+      changes.append(tiddler)
+
+  tiddlerStore = await loadedTiddlerStore(request)
+  changes = [
+    aChange if isinstance(aChange, str) else
+    unskinnyTiddler(tiddlerStore, aChange)
+    for aChange in changes
+  ]
+
+  changedFiles = await storeTiddlerChanges(request, changes)
+
+  results : list[dict[str, Any]] = []
+  for aChange, someFiles in zip(changes, changedFiles) :
+    if isinstance(aChange, str) :
+      results.append({
+        "title": aChange, "status": 200 if someFiles else 404
+      })
+    else :
+      results.append({
+        "title": aChange['title'],
+        "status": 204 if someFiles else 404,
+        "etag": tiddlerEtag(aChange)
+      })
+
+  if any(changedFiles) :
+    reloadTiddlyWiki(request.app)
+  return JSONResponse(results)
+
+appRoutes.append(Route(
+  '/recipes/all/tiddlers.json', endpoint=postBulkTiddlers, methods=['POST']
+))
+
 def createTiddlyWikiApp(aWiki : WikiDef) -> Starlette :
   """
   Create an Starlette application for the TiddlyServer.
@@ -228,11 +745,43 @@ def createTiddlyWikiApp(aWiki : WikiDef) -> Starlette :
 
   # Create app
   tiddlerApp = Starlette(routes=appRoutes)
+  lazyText = None
+  if aWiki['lazyTextSize'] or aWiki['lazyTextTitles'] :
+    lazyText = LazyText(
+      int(aWiki['lazyTextSize']), list(aWiki['lazyTextTitles'])
+    )
   tiddlerApp.state.emptyHtmlFilename = Path(aWiki['emptyHtml']).resolve()
   tiddlerApp.state.baseHtmlFilename  = Path(aWiki['baseHtml']).resolve()
   tiddlerApp.state.tiddlerDir        = Path(tiddlerDir).resolve()
+  tiddlerApp.state.tiddlerStore      = TiddlerStore(
+    tiddlerApp.state.tiddlerDir,
+    extraTiddlers=getExtraTiddlers(tiddlerUrl),
+    changeLogSize=int(aWiki['changeLogSize']),
+    readWorkers=int(aWiki['readWorkers']),
+    lazyText=lazyText
+  )
   tiddlerApp.state.wikiUrl           = tiddlerUrl
   tiddlerApp.state.name              = tiddlerName
+  tiddlerApp.state.indexTimeout      = float(aWiki['indexTimeout'])
+  tiddlerApp.state.serveStale        = bool(aWiki['serveStale'])
+  tiddlerApp.state.maxStaleness      = float(aWiki['maxStaleness'])
+  tiddlerApp.state.streamIndex       = bool(aWiki['streamIndex'])
+  tiddlerApp.state.gzipIndex         = bool(aWiki['gzipIndex'])
+  tiddlerApp.state.splitStore        = bool(aWiki['splitStore'])
+  tiddlerApp.state.watchTiddlers     = bool(aWiki['watchTiddlers'])
+  tiddlerApp.state.watchDebounce     = float(aWiki['watchDebounce'])
+  tiddlerApp.state.watchPollInterval = float(aWiki['watchPollInterval'])
+  tiddlerApp.state.rebuildQuietPeriod = float(aWiki['rebuildQuietPeriod'])
+  tiddlerApp.state.rebuildMaxDelay    = float(aWiki['rebuildMaxDelay'])
+  tiddlerApp.state.packBackend = aWiki['packBackend']
+  tiddlerApp.state.durability  = aWiki['durability']
+  tiddlerApp.state.binaryTiddlers = aWiki['binaryTiddlers']
+  tiddlerApp.state.preload     = aWiki['preload']
+  tiddlerApp.state.priority    = float(aWiki['priority'])
+  tiddlerApp.state.snapshotPath = None
+  if aWiki['snapshot'] :
+    tiddlerApp.state.snapshotPath = Path(aWiki['snapshot']).resolve()
+  tiddlerApp.state.snapshotInterval = float(aWiki['snapshotInterval'])
 
   return tiddlerApp
 
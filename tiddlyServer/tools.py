@@ -12,7 +12,8 @@ import yaml
 
 from tiddlyServer.configuration import loadConfig
 from tiddlyServer.tiddlerSerDes import packTiddlyWikiBlocking, \
-  unpackTiddlyWiki
+  unpackTiddlyWiki, readAllTiddlersBlocking
+from tiddlyServer.tiddlerEmbedding import TiddlerFragments
 
 class ExitNow(Exception) :
   pass
@@ -90,8 +91,12 @@ def pack() :
     sys.exit(1)
 
   theWiki = config['wikis'][args.wikiKey]
+  fragments = TiddlerFragments()
+  fragments.putTiddlers(readAllTiddlersBlocking(Path(theWiki['dir'])))
   html = packTiddlyWikiBlocking(
-    Path(theWiki['baseHtml']), Path(theWiki['dir']), None
+    Path(theWiki['baseHtml']),
+    fragments.orderedFragments(),
+    fragments.wikiTitle()
   )
 
   with open(args.htmlPath, 'w') as htmlFile :
@@ -1,5 +1,5 @@
 
-from typing import Iterable
+from typing import Any, Iterable
 
 type Tiddler = dict[str, str]
 
@@ -7,7 +7,12 @@ type Tiddlers = Iterable[Tiddler]
 
 type TiddlerList = list[Tiddler]
 
-type WikiDef = dict[str,str]
+# A wiki's (per-wiki) configuration, whose values are strings, numbers,
+# booleans, lists or None (see configuration.checkAWiki)
+type WikiDef = dict[str, Any]
 
-type WikiDefs = dict[str, dict[str,str]]
+type WikiDefs = dict[str, WikiDef]
 
+# The modification time and size of a .tid file (or of a .json file and
+# its .text file)
+type FileStat = tuple[int, ...]